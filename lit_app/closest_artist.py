@@ -0,0 +1,88 @@
+'''
+    Rank the artists by how close their style targets are to a photo's
+
+    The photo's Gram matrices are computed once (at a small size: the
+    score is normalised, so it barely depends on resolution) and compared
+    with every artist's targets in one matrix product per layer. The
+    targets are kept stacked in memory, so a ranking costs one small
+    forward pass plus a few matrix-vector products.
+'''
+
+import tensorflow as tf
+import numpy as np
+from datetime import datetime
+
+from extract_styles import load_style_extractor
+from style_store    import style_store
+from style_pack     import triangle_size
+
+import sys
+sys.path.append('../utilities')
+from utilities import class_names, upper_triangle, triangle_weights
+
+# The artist name that asks for the closest artist (must match in utilities/app_utilities.py)
+auto_artist  = 'auto'
+ranking_size = 128
+
+def dot_weights(size):
+    # For upper triangles: off-diagonal entries scaled by sqrt(2), so dot
+    #  products of weighted triangles equal those of the full matrices
+    return np.sqrt(triangle_weights(size))
+
+class ArtistRanker:
+    '''
+        rank(image) returns (artist, similarity) pairs, closest first. The
+        similarity is the cosine similarity of the Gram matrices, averaged
+        over the style layers (1 is identical)
+    '''
+    def __init__(self, artists = None, size = ranking_size):
+        self.artists   = artists or [str(artist) for artist in class_names]
+        self.size      = size
+        self.extractor = None
+        self.targets   = None
+        self.weights   = None
+
+    def load(self):
+        # One (num_artists, n(n+1)/2) matrix of unit-norm triangles per layer
+        layers = None
+        for artist in self.artists:
+            triangles = [target.numpy()[0] for target in style_store.get(artist)[1:]]
+            if layers is None:
+                layers       = [[] for _ in triangles]
+                self.weights = [dot_weights(triangle_size(len(triangle))) for triangle in triangles]
+            for layer, triangle, weights in zip(layers, triangles, self.weights):
+                triangle = triangle * weights
+                layer.append(triangle / np.linalg.norm(triangle))
+        self.weights   = [tf.constant(weights) for weights in self.weights]
+        self.targets   = [tf.constant(np.stack(layer)) for layer in layers]
+        self.extractor = load_style_extractor(self.size, self.size)
+
+    @tf.function(input_signature = [tf.TensorSpec([1, None, None, 3], tf.float32)])
+    def similarities(self, image):
+        image = tf.image.resize(image, (self.size, self.size))
+        grams = self.extractor(image)
+        if not isinstance(grams, list):
+            grams = [grams]
+        scores = []
+        for gram, weights, targets in zip(grams, self.weights, self.targets):
+            triangle = upper_triangle(gram)[0] * weights
+            triangle = triangle / tf.norm(triangle)
+            scores.append(tf.linalg.matvec(targets, triangle))
+        return tf.add_n(scores) / len(scores)
+
+    def rank(self, image):
+        if self.targets is None:
+            self.load()
+        scores = self.similarities(image).numpy()
+        order  = np.argsort(-scores)
+        return [(self.artists[index], float(scores[index])) for index in order]
+
+    def closest(self, image):
+        start   = datetime.now()
+        ranking = self.rank(image)
+        seconds = (datetime.now() - start).total_seconds()
+        top     = ', '.join(f'{artist.strip()} {score:.3f}' for artist, score in ranking[:3])
+        print(f'Closest artists ({seconds * 1000:.0f}ms): {top}')
+        return ranking[0][0]
+
+artist_ranker = ArtistRanker()
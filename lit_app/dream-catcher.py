@@ -15,6 +15,8 @@ from app_utilities import (
     dreamt_dir,
     dream_base_dir,
     dreamt_file_name,
+    preview_file_name,
+    check_for_preview,
     post_file,
     fetch_file,
     get_undreamt_files,
@@ -41,6 +43,11 @@ def check_for_new_dreams():
 
     lines = [l.strip() for l in lines]
     for file_name in undreamt_files:
+        preview_name = preview_file_name(file_name)
+        if preview_name in lines and not check_for_preview(file_name):
+            if fetch_file(preview_name):
+                print(f'{file_name} -- preview fetched')
+
         dreamt_name = dreamt_file_name(file_name)
         if dreamt_name in lines:
             print(f'{file_name} -- dream detected remotely')
@@ -0,0 +1,240 @@
+'''
+    Dream with a pool of worker processes, each pinned to its own cores
+
+    One TensorFlow process stops scaling after a handful of cores at batch
+    size 1, so a big machine runs several: the supervisor (this process)
+    splits the cores it may use into contiguous blocks of cores_per_worker,
+    and each worker is pinned to its block, with TensorFlow's thread pools
+    sized to match. Workers are spawned (not forked), and nothing at the top
+    of this module imports TensorFlow, so each worker sets up its threads
+    before TensorFlow starts, then loads its own models.
+
+    The supervisor watches the base image directory and hands names out
+    on one shared queue. Each worker takes them through remote_watcher's
+    DreamPipeline, so decoding and encoding overlap its dreaming as in the
+    single process server, but decodes at most decode_ahead job ahead of
+    its dreaming, so a busy worker does not hold jobs an idle one could
+    take. A worker that dies is started again on the same cores, and the
+    jobs it had claimed are queued again (the ledger records which worker
+    claimed each job). One that keeps dying is restarted after longer and
+    longer delays, and given up on after max_restarts.
+
+    Memory: every worker has its own TensorFlow runtime, models and style
+    models. Style targets are read in place from the memory-mapped pack,
+    so the workers share one copy of them. The closest artist ranker's
+    (normalised) targets, about 65MB, are still per worker.
+
+        python dream_workers.py [num_workers]
+        python dream_workers.py --smoke photo.jpg
+'''
+
+import multiprocessing as mp
+import threading
+import shutil
+import time
+import os
+
+from file_watcher import Watcher, JobQueue
+from job_ledger import JobLedger
+
+import sys
+sys.path.append('../utilities/')
+
+cores_per_worker   = 4
+# Decode threads per worker, and jobs each may decode ahead of its dreaming
+#  (see DreamPipeline)
+decode_workers     = 1
+decode_ahead       = 1
+# Seconds between checks on the workers
+monitor_interval   = 1.0
+# A worker that dies is restarted after restart_delay seconds, doubling (up
+#  to max_restart_delay) each time it dies again without having run for
+#  stable_seconds; after max_restarts such deaths in a row it is given up on
+restart_delay      = 1.0
+max_restart_delay  = 300.0
+stable_seconds     = 600.0
+max_restarts       = 10
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def worker_cores(index, num_workers, cores):
+    # Contiguous blocks (neighbouring cores tend to share caches); the last
+    #  worker takes any left over. More workers than cores share them
+    size  = max(1, len(cores) // num_workers)
+    start = index * size % len(cores)
+    if index == num_workers - 1:
+        return cores[start:]
+    return cores[start:start + size]
+
+def run_worker(name, cores, names):
+    '''
+        A worker process: pin to cores, size TensorFlow's thread pools,
+        load the models and dream the names on the queue until a None
+    '''
+    # All before TensorFlow is imported: it sizes its pools when it starts
+    intra_threads = len(cores)
+    inter_threads = min(2, len(cores))
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    os.environ['OMP_NUM_THREADS']        = str(intra_threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(intra_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(inter_threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+
+    import remote_watcher
+    remote_watcher.worker_name = name
+    remote_watcher.load_models()
+    remote_watcher.warm_up()
+    print(f'{name} -- ready on cores {cores}')
+    remote_watcher.DreamPipeline(names, decode_workers = decode_workers, max_queued = decode_ahead).run()
+
+class DreamWorkers:
+    '''
+        num_workers processes (default: as many blocks of cores_per_worker
+        as there are cores) dreaming from one queue, restarted if they die
+    '''
+    def __init__(self, num_workers = None, cores_per_worker = cores_per_worker):
+        cores            = available_cores()
+        num_workers      = num_workers or max(1, len(cores) // cores_per_worker)
+        self.context     = mp.get_context('spawn')
+        self.names       = self.context.Queue()
+        self.cores       = [worker_cores(index, num_workers, cores) for index in range(num_workers)]
+        self.workers     = [None] * num_workers
+        self.started     = [None] * num_workers
+        self.restarts    = [0] * num_workers
+        self.restart_at  = [None] * num_workers
+        self.ledger      = JobLedger()
+        self.stopping    = threading.Event()
+
+    def start_worker(self, index):
+        name    = f'dream-worker-{index}'
+        process = self.context.Process(target = run_worker, args = (name, self.cores[index], self.names),
+                                       name = name, daemon = True)
+        process.start()
+        self.workers[index] = process
+        self.started[index] = time.time()
+
+    def start(self):
+        for index in range(len(self.workers)):
+            self.start_worker(index)
+
+    def forward(self, jobs):
+        # From the watcher's queue (which drops repeat events) to the workers'
+        while True:
+            self.names.put(jobs.get())
+
+    def monitor(self):
+        # Until stopped, or every worker has been given up on
+        while not self.stopping.wait(monitor_interval):
+            for index, process in enumerate(self.workers):
+                if process is None or process.is_alive():
+                    continue
+                if self.restart_at[index] is None:
+                    self.died(index)
+                elif time.time() >= self.restart_at[index]:
+                    self.restart_at[index] = None
+                    self.start_worker(index)
+            if all(process is None for process in self.workers):
+                print('All dream workers have been given up on')
+                return
+
+    def died(self, index):
+        # Requeue the dead worker's jobs, and schedule its restart (or give up)
+        process = self.workers[index]
+        for file_name in self.ledger.recover(process.name):
+            print(f'{file_name} -- interrupted, queued again')
+            self.names.put(file_name)
+        if time.time() - self.started[index] >= stable_seconds:
+            self.restarts[index] = 0
+        self.restarts[index] += 1
+        if self.restarts[index] > max_restarts:
+            print(f'{process.name} -- exited with code {process.exitcode}, '
+                  f'{max_restarts} restarts in a row failed, giving up on it')
+            self.workers[index] = None
+            return
+        delay = min(restart_delay * 2 ** (self.restarts[index] - 1), max_restart_delay)
+        print(f'{process.name} -- exited with code {process.exitcode}, restarting in {delay:.0f}s')
+        self.restart_at[index] = time.time() + delay
+
+    def stop(self, timeout = 30):
+        # Workers finish the dream in hand, then exit. A None stops one
+        #  worker's pipeline, but any of its decode threads may take it
+        self.stopping.set()
+        workers = [process for process in self.workers if process is not None]
+        for _ in range(len(workers) * decode_workers):
+            self.names.put(None)
+        for process in workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+def smoke_test(path, timeout = 1800):
+    '''
+        Start one worker and have it dream a copy of the image at path,
+        under a new name in the base image directory. True if the job
+        ends done, with its dream written, before timeout (seconds)
+    '''
+    from remote_dreamer import dream_base_dir, dreamt_dir
+    from app_utilities import check_for_dream
+
+    file_name = f'smoke-{int(time.time())}-{os.path.basename(path)}'
+    shutil.copy(path, dream_base_dir + file_name)
+    pool  = DreamWorkers(1)
+    start = time.time()
+    pool.start()
+    pool.names.put(file_name)
+    state = None
+    while time.time() - start < timeout and pool.workers[0].is_alive():
+        time.sleep(monitor_interval)
+        rows  = pool.ledger.execute('SELECT state FROM jobs WHERE file_name = ?', (file_name,))
+        state = rows[0]['state'] if rows else None
+        if state in ['done', 'failed']:
+            break
+    exit_code = pool.workers[0].exitcode
+    pool.stop()
+
+    passed = state == 'done' and check_for_dream(file_name, dreamt_dir = dreamt_dir)
+    print(f'Smoke test {"passed" if passed else "FAILED"}: {file_name} ended {state} '
+          f'in {time.time() - start:.0f}s' + (f' (worker exited with code {exit_code})'
+                                                if exit_code is not None else ''))
+    return passed
+
+def main(num_workers = None):
+    # Imported here: workers import this module too, and must not start
+    #  TensorFlow (which these do) before they have set up its threads
+    from remote_dreamer import dream_base_dir, dreamt_dir
+    from app_utilities import get_undreamt_files
+
+    pool    = DreamWorkers(num_workers)
+    jobs    = JobQueue()
+    watcher = Watcher(dream_base_dir, jobs, 'dream-workers')
+    watcher.start()
+    # Jobs cut off by a crash, jobs still queued, and anything that arrived
+    #  while the server was down
+    for file_name in pool.ledger.recover():
+        print(f'{file_name} -- interrupted, queued again')
+    for file_name in pool.ledger.pending() + get_undreamt_files(dream_base_dir, dreamt_dir):
+        jobs.put(file_name)
+    print(f'Jobs: {pool.ledger.counts()}')
+
+    pool.start()
+    threading.Thread(target = pool.forward, args = (jobs,), daemon = True).start()
+    print(f'\n-----------------------------------------\n'
+          f'{len(pool.workers)} dream workers on cores {pool.cores}')
+    try:
+        pool.monitor()
+    except KeyboardInterrupt:
+        print('\n Dream workers terminated by user')
+    finally:
+        watcher.stop()
+        pool.stop()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--smoke']:
+        sys.exit(0 if smoke_test(sys.argv[2]) else 1)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -0,0 +1,169 @@
+'''
+    Extract every artist's style targets from the whole dataset
+
+    Each artwork is streamed through the classifier's VGG19 style layers
+    (decoded and resized in parallel by tf.data), and the Gram matrices are
+    averaged per artist (as their upper triangles). The running means are
+    kept as a pack next to a manifest of the artworks already seen, so a
+    later run only reads new artworks and folds them into the means.
+
+    Writes the pack that StyleStore serves:
+        python extract_styles.py [artist ...]
+'''
+
+import tensorflow as tf
+import numpy as np
+import json
+import glob
+import os
+from datetime import datetime
+
+from tensorflow.keras.layers import Lambda, Dense, Input, InputLayer
+from tensorflow.keras.models import Model, load_model
+
+from style_pack import PackedStyles, write_pack, style_pack
+
+import sys
+sys.path.append('../utilities')
+from utilities import (
+    vgg19_process_image,
+    gram_matrix,
+    upper_triangle,
+    class_names,
+)
+
+# Must match in remote_dreamer_in_style.py
+width = height = 896
+style_layers   = ['block1_conv1', 'block2_conv1', 'block3_conv1', 'block4_conv1', 'block5_conv1']
+
+dataset_dir    = '../dataset/images/'
+splits         = ['train']
+# Running means and the artworks they include
+style_means    = '../dreaming/style-means.pack'
+style_manifest = '../dreaming/style-manifest.json'
+batch_size     = 4
+
+def load_style_extractor(width = width, height = height):
+    # The classifier up to its first Dense layer, with a Gram matrix per style layer
+    base_model = load_model('../classification/logs/models/vgg19-INet-down2-b.hdf5')
+
+    input_ = Input(shape = (width, height, 3))
+    signal = input_
+    style_outputs = []
+    for layer in base_model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        elif isinstance(layer, Dense):
+            break
+        signal = layer(signal)
+
+        if layer.name in style_layers:
+            style_outputs.append(Lambda(gram_matrix, name = f'gram_{layer.name}')(signal))
+        if len(style_outputs) == len(style_layers):
+            break
+
+    return Model(inputs = [input_], outputs = style_outputs, name = 'style_extractor')
+
+def artwork_paths(artist, splits = splits):
+    # Paths relative to dataset_dir, so the manifest survives moving the dataset
+    paths = []
+    for split in splits:
+        pattern = os.path.join(dataset_dir, split, glob.escape(artist), '*.jpg')
+        paths  += [os.path.relpath(path, dataset_dir) for path in glob.glob(pattern)]
+    return sorted(paths)
+
+def artwork_dataset(paths, width = width, height = height, batch_size = batch_size):
+    def decode(path):
+        image = tf.io.read_file(path)
+        image = tf.image.decode_jpeg(image, channels = 3)
+        image = vgg19_process_image(tf.cast(image, tf.float32))
+        return tf.image.resize(image, (width, height))
+
+    full_paths = [os.path.join(dataset_dir, path) for path in paths]
+    ds = tf.data.Dataset.from_tensor_slices(full_paths)
+    ds = ds.map(decode, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+    # Skip unreadable files rather than losing the whole artist
+    ds = ds.apply(tf.data.experimental.ignore_errors())
+    return ds.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+def load_manifest(path = style_manifest):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, path = style_manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+def update_means(extractor, paths, means, count):
+    '''
+        Fold the Gram matrices (triangles) of the artworks at paths into the
+        running means (float64 arrays, or None) over count artworks so far
+    '''
+    for batch in artwork_dataset(paths, *extractor.input_shape[1:3]):
+        grams = extractor(batch)
+        if not isinstance(grams, list):
+            grams = [grams]
+        grams = [upper_triangle(gram).numpy().astype(np.float64) for gram in grams]
+        added = grams[0].shape[0]
+        if means is None:
+            means = [np.zeros(gram.shape[1:]) for gram in grams]
+        for mean, gram in zip(means, grams):
+            mean += (gram.sum(axis = 0) - added * mean) / (count + added)
+        count += added
+    return means, count
+
+def extract_style_targets(artists = None, splits = splits, out_path = style_pack,
+                          means_path = style_means, manifest_path = style_manifest):
+    '''
+        Bring the targets of the given artists (default: all) up to date with
+        the dataset, then rewrite the means and the served pack. Artworks in
+        the manifest are not read again
+    '''
+    artists   = artists or [str(artist) for artist in class_names]
+    manifest  = load_manifest(manifest_path)
+    previous  = PackedStyles(means_path) if os.path.exists(means_path) else None
+    targets   = {}
+    if previous is not None:
+        targets = {artist : previous.triangles(artist) for artist in previous.artists()}
+
+    extractor = None
+    for artist in artists:
+        entry = manifest.get(artist, {'count' : 0, 'files' : []})
+        if artist not in targets:
+            # Without its means, an artist starts over
+            entry = {'count' : 0, 'files' : []}
+        seen  = set(entry['files'])
+        new   = [path for path in artwork_paths(artist, splits) if path not in seen]
+        if not new:
+            print(f'{artist}: up to date ({entry["count"]} artworks)')
+            continue
+
+        extractor = extractor or load_style_extractor()
+        start     = datetime.now()
+        means     = None
+        if entry['count'] > 0:
+            means = [target.astype(np.float64) for target in targets[artist]]
+        means, count = update_means(extractor, new, means, entry['count'])
+        if means is None:
+            print(f'{artist}: no readable artworks')
+            continue
+
+        targets[artist]  = [mean.astype(np.float32) for mean in means]
+        manifest[artist] = {'count' : count, 'files' : sorted(seen | set(new))}
+        seconds = (datetime.now() - start).total_seconds()
+        print(f'{artist}: added {count - entry["count"]} of {len(new)} new artworks '
+              f'({count} total) in {seconds:.1f}s')
+
+    # The means are written first: the manifest must never claim more than they hold
+    write_pack(targets, means_path)
+    save_manifest(manifest, manifest_path)
+    write_pack(targets, out_path)
+    return out_path
+
+if __name__ == '__main__':
+    out_path = extract_style_targets(sys.argv[1:] or None)
+    print(f'Wrote {out_path} ({os.path.getsize(out_path) / 2**20:.1f}MB)')
@@ -1,5 +1,9 @@
+import os
 import time
+import queue
+import threading
 from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 
 
 class Watcher:
@@ -9,9 +13,17 @@ class Watcher:
         self.event_handler = handler
         self.name = name
 
-    def run(self):
+    # Watch in the background (the observer's own thread) until stop()
+    def start(self):
         self.observer.schedule(self.event_handler, self.directory_to_watch, recursive=True)
         self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+    def run(self):
+        self.start()
         try:
             print(f'\n-----------------------------------------\n'
                   f'Watcher {self.name} all set up')
@@ -25,3 +37,40 @@ class Watcher:
             print(f'Unknown error in watcher {self.name}')
 
         self.observer.join()
+
+class JobQueue(FileSystemEventHandler):
+    '''
+        Base images waiting to be dreamt, fed by file system events
+
+        A name is queued once until it is taken. Only finished files are
+        queued: on a file closed after writing (inotify, as on the Linux
+        server) or renamed into place, never on a write still in progress.
+    '''
+    event_types = ['closed', 'moved']
+
+    def __init__(self):
+        self.queue  = queue.Queue()
+        self.queued = set()
+        self.lock   = threading.Lock()
+
+    def put(self, file_name):
+        with self.lock:
+            if file_name in self.queued:
+                return
+            self.queued.add(file_name)
+        self.queue.put(file_name)
+
+    def get(self):
+        # Blocks (without polling) until there is a job
+        file_name = self.queue.get()
+        with self.lock:
+            self.queued.discard(file_name)
+        return file_name
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in self.event_types:
+            return
+        path = event.dest_path if event.event_type == 'moved' else event.src_path
+        file_name = os.path.basename(path)
+        if not file_name.startswith('.'):
+            self.put(file_name)
@@ -15,7 +15,8 @@ from app_utilities import (
     dream_base_dir,
     dreamt_file_name,
     post_file,
-    fetch_file
+    fetch_file,
+    snapshot_dream_spec
 )
 
 # Alias I am so so sorry
@@ -48,6 +49,8 @@ class Handler(FileSystemEventHandler):
             elif file_type in ['heic', 'heis']:
                 print(f'{bare_name} -- Converting HEIC to jpg')
                 safe_bare_name = bare_name.replace(' ', '_')
+                # Before converting: the jpg is posted with the spec selected now
+                snapshot_dream_spec(f'{safe_bare_name}.jpg')
                 command = f'magick "{event.src_path}" "{local_ingest_dir}{safe_bare_name}.jpg"'
                 os.system(command)
 
@@ -0,0 +1,159 @@
+'''
+    Durable record of every dream job, in SQLite
+
+    Jobs are keyed by the base image's name and the hash of its contents
+    (with its spec), so a new name or a new spec is a new job, and move
+    queued -> running -> done, or to failed once max_attempts runs have
+    failed. Jobs found running at start up were cut off by a crash and are
+    queued again. pending() reads the queued jobs off an index on state,
+    so it costs O(pending) whatever the size of the archive.
+'''
+
+import sqlite3
+import hashlib
+import json
+import os
+import threading
+import time
+
+ledger_path  = '../dream-jobs.sqlite'
+max_attempts = 3
+
+schema = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        file_name   TEXT NOT NULL,
+        file_hash   TEXT NOT NULL,
+        state       TEXT NOT NULL CHECK (state IN ('queued', 'running', 'done', 'failed')),
+        attempts    INTEGER NOT NULL DEFAULT 0,
+        params      TEXT,
+        error       TEXT,
+        queued_at   REAL,
+        started_at  REAL,
+        finished_at REAL,
+        seconds     REAL,
+        worker      TEXT,
+        PRIMARY KEY (file_name, file_hash)
+    );
+    CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, queued_at);
+    CREATE INDEX IF NOT EXISTS jobs_by_name  ON jobs (file_name);
+'''
+
+def hash_file(path, *sidecars):
+    # The file's contents, then those of any sidecars that exist
+    digest = hashlib.sha256()
+    for index, file_path in enumerate((path,) + sidecars):
+        if index > 0 and not os.path.exists(file_path):
+            continue
+        with open(file_path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class JobLedger:
+    '''
+        The jobs table, safe to share between threads. Each method is one
+        transaction
+    '''
+    def __init__(self, path = ledger_path, max_attempts = max_attempts):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db   = sqlite3.connect(path, check_same_thread = False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.executescript(schema)
+
+    def execute(self, sql, args = ()):
+        with self.lock, self.db:
+            return self.db.execute(sql, args).fetchall()
+
+    def enqueue(self, file_name, file_hash):
+        '''
+            Record a base image (if new) and return its job's state. An
+            earlier queued version of the same file (e.g. half written) is
+            replaced
+        '''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM jobs WHERE file_name = ? AND file_hash != ? AND state = ?',
+                            (file_name, file_hash, 'queued'))
+            self.db.execute('INSERT OR IGNORE INTO jobs (file_name, file_hash, state, queued_at) '
+                            'VALUES (?, ?, ?, ?)', (file_name, file_hash, 'queued', time.time()))
+            row = self.db.execute('SELECT state FROM jobs WHERE file_name = ? AND file_hash = ?',
+                                  (file_name, file_hash)).fetchone()
+        return row['state']
+
+    def known(self, file_name):
+        # Whether any version of the file has been recorded
+        return bool(self.execute('SELECT 1 FROM jobs WHERE file_name = ? LIMIT 1', (file_name,)))
+
+    def start(self, file_name, file_hash, params = None, worker = None):
+        # Claim a queued job; False if it is not queued (e.g. another thread
+        #  or worker process has it)
+        with self.lock, self.db:
+            cursor = self.db.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, params = ?, '
+                                     'started_at = ?, error = NULL, worker = ? '
+                                     'WHERE file_name = ? AND file_hash = ? AND state = ?',
+                                     ('running', json.dumps(params), time.time(), worker,
+                                      file_name, file_hash, 'queued'))
+        return cursor.rowcount == 1
+
+    def finish(self, file_name, file_hash):
+        now = time.time()
+        self.execute('UPDATE jobs SET state = ?, finished_at = ?, seconds = ? - started_at '
+                     'WHERE file_name = ? AND file_hash = ?', ('done', now, now, file_name, file_hash))
+
+    def fail(self, file_name, file_hash, error, retry = False):
+        # Back to queued if retry and attempts remain; returns the new state.
+        #  A job not in the ledger is recorded as failed
+        now = time.time()
+        with self.lock, self.db:
+            row   = self.db.execute('SELECT attempts FROM jobs WHERE file_name = ? AND file_hash = ?',
+                                    (file_name, file_hash)).fetchone()
+            if row is None:
+                self.db.execute('INSERT INTO jobs (file_name, file_hash, state, error, queued_at, finished_at) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', (file_name, file_hash, 'failed', str(error), now, now))
+                return 'failed'
+            state = 'queued' if retry and row['attempts'] < self.max_attempts else 'failed'
+            self.db.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? '
+                            'WHERE file_name = ? AND file_hash = ?',
+                            (state, str(error), now, file_name, file_hash))
+        return state
+
+    def fail_queued(self, file_name, error):
+        # Give up on a file's queued job(s), e.g. one that cannot be prepared
+        self.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE file_name = ? AND state = ?',
+                     ('failed', str(error), time.time(), file_name, 'queued'))
+
+    def recover(self, worker = None):
+        # Jobs left running by a crash (of everything, or of one worker):
+        #  queue them again, or give up on them. Returns the names queued
+        where = 'state = ?' + ('' if worker is None else ' AND worker = ?')
+        args  = ('running',) + (() if worker is None else (worker,))
+        with self.lock, self.db:
+            crashed = self.db.execute(f'SELECT file_name FROM jobs WHERE {where} AND attempts < ?',
+                                      args + (self.max_attempts,)).fetchall()
+            self.db.execute(f'UPDATE jobs SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, '
+                            f'error = ? WHERE {where}',
+                            (self.max_attempts, 'queued', 'failed', 'interrupted') + args)
+        return [row['file_name'] for row in crashed]
+
+    def pending(self):
+        rows = self.execute('SELECT file_name FROM jobs WHERE state = ? ORDER BY queued_at', ('queued',))
+        return [row['file_name'] for row in rows]
+
+    def state(self, file_name, file_hash):
+        rows = self.execute('SELECT state FROM jobs WHERE file_name = ? AND file_hash = ?',
+                            (file_name, file_hash))
+        return rows[0]['state'] if rows else None
+
+    def job(self, file_name, file_hash):
+        rows = self.execute('SELECT * FROM jobs WHERE file_name = ? AND file_hash = ?',
+                            (file_name, file_hash))
+        if not rows:
+            return None
+        job = dict(rows[0])
+        job['params'] = json.loads(job['params']) if job['params'] else None
+        return job
+
+    def counts(self):
+        rows = self.execute('SELECT state, COUNT(*) AS count FROM jobs GROUP BY state')
+        return {row['state'] : row['count'] for row in rows}
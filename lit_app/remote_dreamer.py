@@ -9,14 +9,18 @@ from utilities import (
     vgg19_process_image,
     Timer,
     load_image,
-    dummy_input,
-    get_image_from_model
+    dummy,
+    get_image_from_model,
+    get_compiled_step,
+    StopCriterion,
+    nearest_bucket,
 )
 
 from tensorflow.keras.models import load_model
-from tensorflow.keras.optimizers import Adam
 
 model_path = './test-model.hdf5'
+# Opt in to XLA for the optimisation steps (kept only where it measures faster)
+jit_compile = False
 dream_base_dir = '../dream-base-images/'
 dreamt_dir     = '../dreamt-images/'
 
@@ -30,24 +34,32 @@ def load_dream_model():
     opt = tf.optimizers.Adam(learning_rate = 100.0)
     return model, width, height
 
-def dream(model, image, nat_width, nat_height):
-    # Load the Image into the Model
-    image_layer = model.get_layer('image')
-    image_layer.set_weights([image.numpy()])
+def dream(model, image, nat_width, nat_height, budget = None, patience = None):
+    # Load the Image into the Model and run the (persistent) optimiser,
+    #  stopping early on a time budget (seconds) or loss plateau if given.
+    #  The model's image size is fixed, so there is no coarse pass (and no
+    #  preview) on this path
+    step = get_compiled_step(model, learning_rate = 100.0, jit_compile = jit_compile)
+    if budget is None and patience is None:
+        step(image, 3, dummy)
+    else:
+        step.run_until(image, dummy, StopCriterion(budget, patience), max_steps = 3)
 
-    # Compile the model
-    opt = Adam(lr = 100.0)
-    model.compile(optimizer = opt, loss = precomputed_loss)
-    model.fit(dummy_input.repeat(1), epochs = 3)
+    return decode_dream(model, nat_width, nat_height)
 
-    img = get_image_from_model(model)
+def decode_dream(model, nat_width, nat_height, index = 0):
+    img = get_image_from_model(model, index = index)
     img = tf.image.resize(img, [nat_width, nat_height], method = 'gaussian')
     img = tf.cast(img, tf.uint8)
     return img
 
-def load_lit_image(image_path, width, height, mode = 'vgg19'):
+def load_lit_image(image_path, width = None, height = None, mode = 'vgg19', buckets = None):
+    # Without a width and height the image is resized to the nearest of
+    #  buckets (shapes; see nearest_bucket)
     nat_image = load_image(image_path, cast = tf.uint8)
     nat_size  = nat_image.shape[:-1]
+    if width is None or height is None:
+        width, height = nearest_bucket(nat_size, buckets)
     image = tf.image.resize(tf.cast(nat_image, tf.float32), [width, height])
     if mode == 'vgg19':
         image = vgg19_process_image(image)
@@ -56,7 +68,11 @@ def load_lit_image(image_path, width, height, mode = 'vgg19'):
     image = tf.expand_dims(image, axis = 0)
     return image, nat_size
 
-def save_dream(image, file_name):
+def save_dream(image, file_name, prefix = 'dreamt-'):
     image = tf.image.encode_jpeg(image)
-    out_dir = dreamt_dir + 'dreamt-' + file_name[:-4] + '.jpg'
+    out_dir = dreamt_dir + prefix + file_name[:-4] + '.jpg'
     tf.io.write_file(out_dir, image)
+
+def save_preview(image, file_name):
+    # Early result for the app to show while the dream finishes
+    save_dream(image, file_name, prefix = 'preview-')
@@ -2,6 +2,8 @@ import tensorflow as tf
 import tensorflow.keras as keras
 import numpy as np
 import os
+from datetime import datetime
+from collections import OrderedDict
 
 from tensorflow.keras.layers import Lambda, Dense, MaxPool2D, MaxPooling2D, AvgPool2D, Flatten, Layer, Dropout, Input, Subtract, Multiply, Add, InputLayer
 from tensorflow.keras.models import Model, load_model
@@ -9,6 +11,9 @@ from tensorflow.keras.utils  import plot_model
 
 import os
 
+from remote_dreamer import decode_dream
+from style_store    import style_store
+
 import sys
 sys.path.append('../utilities')
 from utilities import (
@@ -19,14 +24,48 @@ from utilities import (
     precomputed_loss,
     get_image_from_model,
     gram_matrix,
+    sampled_gram_matrix,
+    gram_distance,
     Source,
     Timer,
     dummy,
     class_names,
+    get_compiled_step,
+    release_compiled_steps,
+    CompiledStep,
+    optimizers,
+    StopCriterion,
+    resolution_buckets,
+    nearest_bucket,
 )
 
 # Must match in remote_dreamer.py
 width = height = 896
+jit_compile = False
+# Estimate the style layers' Gram matrices from this many locations
+#  (None: exact). See benchmark_gram
+gram_samples = None
+gram_method  = 'random'
+# Per-job style models: each photo is styled at the nearest of these shapes
+#  (the closest aspect ratio, never larger than the photo; the dream is
+#  resized back to the photo's own), so a smaller photo costs less, and a
+#  few models cover every photo and all are built and warmed at start up.
+#  Each warmed shape keeps about 0.85KB per pixel of oneDNN buffers for the
+#  life of the process (dropping its model does not free them): a worker
+#  warmed up at these two sizes is 5GB, and a third size (640) took it past
+#  the 6GB of the test box.
+#  Half of width is also the coarse pass's size (see coarse_bucket)
+style_resolutions = (width // 2, width)
+style_buckets     = resolution_buckets(resolutions = style_resolutions)
+max_style_models  = len(style_buckets)
+# Optimiser for dream_style: 'adam' or 'lbfgs' (see compare_optimizers)
+style_optimizer   = 'adam'
+# Coarse-to-fine style dreams (see dream_style): the coarse pass is at the
+#  bucket nearest coarse_scale of the job's, and the steps taken at each
+#  size, weak and strong, replace the single pass's 2 and 7
+coarse_scale      = 0.5
+coarse_steps      = {False : 2, True : 6}
+fine_steps        = {False : 1, True : 3}
 
 # Should be moved to utilities
 from tensorflow.keras.constraints import Constraint
@@ -40,23 +79,35 @@ class RemainImage(Constraint):
                 (1 - self.rate) * kernel)
 
 
+# The style model's loss: Gram matrices matched at style_layers, and the
+#  mean activation of the output layers raised (dreaming), with these weights
+style_layers  = ['block1_conv1', 'block2_conv1', 'block3_conv1', 'block4_conv1', 'block5_conv1']
+output_layer_weights = {
+#     'dense_2'            : 1.0,
+    'block4_conv1'       : 0.1,
+    'block5_conv1'       : 0.1,
+}
+style_content_weighting = 100.
+
+def load_base_model():
+    return load_model('../classification/logs/models/vgg19-INet-down2-b.hdf5')
+
 # Due to difficulties saving the model, just build it (only happens once)
-def load_dream_style_model():
-    style_layers = ['block1_conv1', 'block2_conv1', 'block3_conv1', 'block4_conv1', 'block5_conv1']
-    base_model = load_model('../classification/logs/models/vgg19-INet-down2-b.hdf5')
-    style_content_weighting = 100.
+#  batch_size > 1 builds a model that styles that many images at once.
+#  Models built from the same base_model share its layers (and weights)
+def load_dream_style_model(width = width, height = height, batch_size = 1,
+                           gram_samples = gram_samples, gram_method = gram_method,
+                           base_model = None):
+    if base_model is None:
+        base_model = load_base_model()
 
     style_layer_weighting   = tf.constant(1/len(style_layers) * style_content_weighting * (1/4))
 
-    input_       = Input(shape = (), batch_size = 1, name = 'dummy_input')
-    image_layer  = Source((1, width, height, 3), name = 'image', kernel_constraint = RemainImage(0.9))
+    input_       = Input(shape = (), batch_size = batch_size, name = 'dummy_input')
+    image_layer  = Source((batch_size, width, height, 3), name = 'image', kernel_constraint = RemainImage(0.9))
     signal       = image_layer(input_)
 
-    output_layers = {
-    #     'dense_2'            : 1.0,
-        'block4_conv1'       : 0.1,
-        'block5_conv1'       : 0.1,
-    }
+    output_layers = dict(output_layer_weights)
     max_pool_extracted_layers = False
 
     # Alias
@@ -78,13 +129,22 @@ def load_dream_style_model():
         return summary_fn
     base_model_layers = base_model.layers
 
+    # Only build up to the deepest layer that feeds the loss
+    needed_layers     = set(output_layers) | set(style_layers)
+    last_needed_index = max(i for i, layer in enumerate(base_model_layers)
+                            if layer.name in needed_layers)
+    base_model_layers = base_model_layers[:last_needed_index + 1]
+
     # Add resampling before flattening to allow larger images
     flatten_index     = next(filter(
                                 lambda i : isinstance(base_model_layers[i], Flatten),
-                                range(len(base_model_layers))))
-    resize_layer      = Lambda(lambda tensor : tf.image.resize(tensor, (7,7), method = 'gaussian'),
+                                range(len(base_model_layers))), None)
+    if flatten_index is not None:
+        resize_layer  = Lambda(lambda tensor : tf.image.resize(tensor, (7,7), method = 'gaussian'),
                                name = 'resize')
-    base_model_layers.insert(flatten_index, resize_layer)
+        base_model_layers.insert(flatten_index, resize_layer)
+
+    top_layer = None
 
     for layer in base_model_layers:
         layer.trainable = False
@@ -118,16 +178,20 @@ def load_dream_style_model():
 
         if layer.name in style_layers:
             output_count += 1
-            gram_matrix_layer = Lambda(gram_matrix, name = f'gram_{layer.name}')
+            gram_fn = gram_matrix
+            if gram_samples is not None:
+                gram_fn = sampled_gram_matrix(gram_samples, gram_method)
+            gram_matrix_layer = Lambda(gram_fn, name = f'gram_{layer.name}')
             gram_signal = gram_matrix_layer(signal)
-            batch_input_shape = gram_signal.shape
-            input_     = Input(shape = batch_input_shape[1:], batch_size=batch_input_shape[0],
+            # The targets are the upper triangles of the artist's Gram
+            #  matrices (see style_pack), matched without expanding them
+            size       = gram_signal.shape[-1]
+            input_     = Input(shape = (size * (size + 1) // 2,), batch_size = gram_signal.shape[0],
                                name = f'arr_{style_input_count}')
             style_input_count += 1
             inputs.append(input_)
-            difference = Subtract()([input_, gram_signal])
-            square     = Lambda(tf.square, name = f'square_{output_count}')(difference)
-            reduce = Lambda(lambda t : tf.reduce_mean(t, axis = [1,2]), name = f'mean_{output_count}')(square)
+            reduce = Lambda(lambda tensors : gram_distance(*tensors),
+                            name = f'mean_{output_count}')([input_, gram_signal])
             scale  = Lambda(lambda x : x * style_layer_weighting, name = f'weight_{output_count}')(reduce)
             outputs.append(scale)
 
@@ -137,26 +201,119 @@ def load_dream_style_model():
 
     # Weights for the top layer (with artist activations)
     #  were reset; restore them
-    top_layer.set_weights(base_model.layers[-1].get_weights())
+    if top_layer is not None:
+        top_layer.set_weights(base_model.layers[-1].get_weights())
 
     return model
 
 
-# Load the Style and set up the dataset for a call to model.fit
+class StyleModels:
+    '''
+        Style models built on demand for each image shape (in serving, one
+        per style bucket, built by warm_up)
+
+        All of them share one copy of the classifier's layers. Only the
+        max_models most recently used are kept; older ones are dropped along
+        with their compiled steps.
+    '''
+    def __init__(self, max_models = max_style_models):
+        self.max_models = max_models
+        self.base_model = None
+        self.models     = OrderedDict()
+
+    def get(self, shape, batch_size = 1):
+        key = (tuple(shape), batch_size)
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        if self.base_model is None:
+            self.base_model = load_base_model()
+        model = load_dream_style_model(*shape, batch_size = batch_size,
+                                       base_model = self.base_model)
+        self.models[key] = model
+        while len(self.models) > self.max_models:
+            _, old_model = self.models.popitem(last = False)
+            release_compiled_steps(old_model)
+        return model
+
+style_models = StyleModels()
+
+# Look up the style model inputs for an artist (cached in memory)
 def load_style(artist):
-    style_path   = f'../dreaming/style-activations/{artist}.npz'
+    return style_store.get(artist)
+
+def coarse_bucket(shape):
+    # The style bucket for the coarse pass of a job at shape (same aspect
+    #  ratio, about coarse_scale of its size), or None if none is smaller
+    bucket = nearest_bucket([max(1, int(side * coarse_scale)) for side in shape], style_buckets)
+    return bucket if bucket[0] * bucket[1] < shape[0] * shape[1] else None
+
+def dream_style(model, image, style, nat_width, nat_height, strong = False,
+                budget = None, patience = None, on_preview = None, coarse_model = None):
+    '''
+        Load the image into the model and run the (persistent) optimiser,
+        stopping early on a time budget (seconds) or loss plateau if given
+
+        With a coarse_model (a smaller style model, see coarse_bucket) the
+        image is first dreamt at its size for coarse_steps, and that dream
+        goes to on_preview. Only the change the coarse dream made is
+        upsampled onto the full-size image (as in DreamImage.decode_dream),
+        which then takes just fine_steps
+    '''
+    num_epochs = 7 if strong else 2
+    if coarse_model is not None:
+        start        = datetime.now()
+        coarse       = tf.image.resize(image, coarse_model.get_layer('image').kernel.shape[1:3])
+        coarse_step  = get_compiled_step(coarse_model, learning_rate = 20.0, jit_compile = jit_compile,
+                                         optimizer = style_optimizer)
+        coarse_step(coarse, coarse_steps[strong], style)
+        if on_preview is not None:
+            on_preview(get_image_from_model(coarse_model))
+        change     = coarse_step.image - coarse
+        image      = image + tf.image.resize(change, image.shape[1:3])
+        num_epochs = fine_steps[strong]
+        if budget is not None:
+            budget = max(0.0, budget - (datetime.now() - start).total_seconds())
+
+    step = get_compiled_step(model, learning_rate = 20.0, jit_compile = jit_compile,
+                             optimizer = style_optimizer)
+    if budget is None and patience is None:
+        step(image, num_epochs, style)
+    else:
+        criterion = StopCriterion(budget, patience)
+        step.run_until(image, style, criterion, max_steps = num_epochs)
 
-    with np.load(style_path, allow_pickle = False) as style_data:
-        style_inputs = [tf.convert_to_tensor(value) for value in style_data.values()]
-    style_data.close()
+    return decode_dream(model, nat_width, nat_height)
 
-    inputs = [dummy] + style_inputs
-    ds = tf.data.Dataset.from_tensor_slices((tuple(inputs), dummy))
-    ds = ds.batch(1)
-    ds = ds.cache()
-    return ds
+def stack_styles(styles):
+    # Batch several artists' style inputs along the first axis
+    batch_size = len(styles)
+    targets    = [tf.concat(layers, axis = 0) for layers in zip(*[style[1:] for style in styles])]
+    return tuple([tf.zeros([batch_size])] + targets)
 
-def dream_style(model, image, style, nat_width, nat_height, strong = False):
+def dream_style_multi(model, image, styles, nat_width, nat_height, strong = False):
+    '''
+        Style one image after several artists in a single optimisation
+
+        model must be built with batch_size = len(styles). The image is
+        copied once per style and all copies are optimised together, one
+        style each; every copy gets the gradients it would get in a run of
+        its own (with Adam, the steps too; L-BFGS keeps one history for the
+        whole batch). Returns one image per style
+    '''
+    step = get_compiled_step(model, learning_rate = 20.0, jit_compile = jit_compile,
+                             optimizer = style_optimizer)
+    num_epochs = 7 if strong else 2
+    images = tf.tile(image, [len(styles), 1, 1, 1])
+    step(images, num_epochs, stack_styles(styles))
+
+    return [decode_dream(model, nat_width, nat_height, index = index)
+            for index in range(len(styles))]
+
+# The per-request compile/fit path replaced by dream_style; kept as the
+#  baseline for compare_latency
+def dream_style_fit(model, image, style, nat_width, nat_height, strong = False):
     # Load the Image into the Model
     image_layer = model.get_layer('image')
     image_layer.set_weights([image.numpy()])
@@ -165,9 +322,127 @@ def dream_style(model, image, style, nat_width, nat_height, strong = False):
     adam = tf.optimizers.Adam(learning_rate = 20.0)
     model.compile(optimizer = adam, loss = precomputed_loss)
     num_epochs = 7 if strong else 2
-    model.fit(style.repeat(num_epochs), epochs = num_epochs, steps_per_epoch = 1)
+    ds = tf.data.Dataset.from_tensors((style, dummy))
+    model.fit(ds.repeat(num_epochs), epochs = num_epochs, steps_per_epoch = 1)
 
     img = get_image_from_model(model)
     img = tf.image.resize(img, [nat_width, nat_height], method = 'gaussian')
     img = tf.cast(img, tf.uint8)
     return img
+
+def compare_latency(model, image, style, trials = 3):
+    # Per-photo latency of the compile/fit path against the compiled step,
+    #  for both strengths. The compiled step's first call (tracing) is
+    #  reported on its own
+    def seconds(dream_fn, strong):
+        start = datetime.now()
+        dream_fn(model, image, style, width, height, strong = strong)
+        return (datetime.now() - start).total_seconds()
+
+    for strong in [False, True]:
+        num_epochs = 7 if strong else 2
+        print(f'compiled step, first call ({num_epochs} epochs): '
+              f'{seconds(dream_style, strong):.3f}s')
+        for name, dream_fn in [('fit', dream_style_fit), ('compiled step', dream_style)]:
+            best = min(seconds(dream_fn, strong) for _ in range(trials))
+            print(f'{name} ({num_epochs} epochs): {best:.3f}s best of {trials}')
+
+def benchmark_xla(resolutions = (448, 672, 896), steps = 5, artist = 'Pablo Picasso'):
+    # Style optimisation steps/sec with and without XLA at each resolution
+    inputs    = load_style(artist)
+    results   = {}
+    for size in resolutions:
+        model = load_dream_style_model(size, size)
+        step  = CompiledStep(model, learning_rate = 20.0)
+        step.reset(tf.random.uniform([1, size, size, 3], -100, 100))
+        results.update(step.benchmark_xla(inputs, steps))
+    return results
+
+def benchmark_gram(size = 896, samples = (4096, 16384, 65536), methods = ('random', 'strided'),
+                   trials = 3, artist = 'Pablo Picasso'):
+    '''
+        Exact against sampled Gram matrices in the style model: relative
+        loss error, cosine similarity of the image gradient with the exact
+        one (averaged over trials, as the samples are redrawn every step)
+        and seconds per gradient step (best of trials)
+    '''
+    inputs = load_style(artist)
+    image  = tf.random.uniform([1, size, size, 3], -100, 100, seed = 0)
+
+    def measure(model):
+        image_variable = model.get_layer('image').kernel
+        image_variable.assign(image)
+        losses, gradients, times = [], [], []
+        for trial in range(trials + 1):
+            start = datetime.now()
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(model(inputs))
+            gradient = tape.gradient(loss, image_variable)
+            seconds  = (datetime.now() - start).total_seconds()
+            # The first call builds the graph; leave it out
+            if trial > 0:
+                losses.append(float(loss))
+                gradients.append(gradient)
+                times.append(seconds)
+        return losses, gradients, min(times)
+
+    exact_losses, exact_gradients, exact_time = measure(load_dream_style_model(size, size))
+    exact_loss     = exact_losses[0]
+    exact_gradient = tf.reshape(exact_gradients[0], [-1])
+    results = {'exact' : {'loss error' : 0.0, 'gradient cosine' : 1.0, 'seconds' : exact_time}}
+    print(f'exact: {exact_time:.3f}s/step')
+
+    for method in methods:
+        for num_samples in samples:
+            model = load_dream_style_model(size, size, gram_samples = num_samples, gram_method = method)
+            losses, gradients, seconds = measure(model)
+            loss_error = np.mean([abs(loss - exact_loss) / abs(exact_loss) for loss in losses])
+            cosine     = np.mean([float(-tf.keras.losses.cosine_similarity(
+                                    exact_gradient, tf.reshape(gradient, [-1])))
+                                  for gradient in gradients])
+            name = f'{method} {num_samples}'
+            results[name] = {'loss error' : loss_error, 'gradient cosine' : cosine, 'seconds' : seconds}
+            print(f'{name}: loss error {loss_error:.1e}, gradient cosine {cosine:.3f}, '
+                  f'{seconds:.3f}s/step ({exact_time / seconds:.2f}x)')
+    return results
+
+def compare_optimizers(image, size = 448, seconds = 60, artist = 'Pablo Picasso',
+                       names = ('adam', 'lbfgs'), steps = 7):
+    '''
+        Style loss against wall-clock time for each optimiser, from the same
+        (pre-processed, size x size) image on an artist's stock targets.
+        Tracing is done before the clock starts. Returns, per optimiser, a
+        list of (seconds, steps, loss): the loss of the image after that
+        many steps, reached after that many seconds. Every optimiser runs
+        at least `steps` steps, and is compared with the first after `steps`
+    '''
+    inputs  = load_style(artist)
+    model   = load_dream_style_model(size, size)
+    one     = tf.constant(1)
+    results = {}
+    for name in names:
+        step = optimizers[name](model, learning_rate = 20.0)
+        step.start(image, inputs, one)
+        step.run(inputs, one)
+        step.reset(image)
+
+        # Each run reports the loss of the image it started from, which was
+        #  there when the previous run ended
+        trace   = []
+        start   = datetime.now()
+        elapsed = 0.0
+        while len(trace) <= steps or elapsed < seconds:
+            loss    = float(step.run(inputs, one))
+            trace.append((elapsed, len(trace), loss))
+            elapsed = (datetime.now() - start).total_seconds()
+        results[name] = trace
+
+    for name, trace in results.items():
+        print(f'{name}: ' + ', '.join(f'{loss:.6g} after {done} steps ({elapsed:.1f}s)'
+                                      for elapsed, done, loss in trace[::max(1, len(trace) // 8)]))
+    losses = {name : trace[steps][2] for name, trace in results.items()}
+    for name, trace in results.items():
+        reached = next((done for _, done, loss in trace if loss <= losses[names[0]]), None)
+        print(f'{name}: {losses[name]:.6g} after {steps} steps; reached {names[0]}\'s {steps}-step loss '
+              f'({losses[names[0]]:.6g}) after {reached} steps')
+    return results
@@ -2,13 +2,16 @@ from remote_dreamer import (
     dream,
     load_lit_image,
     save_dream,
+    save_preview,
     dream_base_dir,
     dreamt_dir,
     load_dream_model
 )
 
 from remote_dreamer_in_style import (
-    load_dream_style_model,
+    style_models,
+    style_buckets,
+    coarse_bucket,
     load_style,
     dream_style
 )
@@ -16,13 +19,39 @@ from remote_dreamer_in_style import (
 import sys
 sys.path.append('../utilities/')
 from app_utilities import (
-    get_undreamt_files
+    get_undreamt_files,
+    check_for_dream,
+    check_dream_spec,
+    spec_file_name,
+    spec_suffix
 )
+from utilities import class_names
+from style_store import style_store
+from style_transform import style_transforms, transform_style
+from user_styles import user_styles, is_user_style
+from closest_artist import artist_ranker, auto_artist
+from file_watcher import Watcher, JobQueue
+from job_ledger import JobLedger, hash_file
 from datetime import datetime
 import tensorflow as tf
-import time
+import threading
+import queue
+import json
+import os
 
-blacklist = []
+ledger = JobLedger()
+# Recorded against the jobs this process runs (set by dream_workers)
+worker_name = None
+
+# Wall-clock budget (seconds) for dreams whose spec sets none; the best
+#  image so far is saved when it runs out. None always runs the full
+#  number of steps
+dream_budget = None
+
+# Style in one forward pass when the artist has a trained transform network
+use_style_transforms = True
+# Style coarse-to-fine, with the coarse dream as the preview (see dream_style)
+coarse_to_fine = True
 
 def get_config():
     with open('dreamer_config.txt', 'r') as f:
@@ -39,48 +68,324 @@ def get_config():
         strength = False
     return type, strength, artist
 
-def process_new_dreams():
-    new_dreams = get_undreamt_files(dream_base_dir, dreamt_dir)
-    for file_name in new_dreams:
-        start = datetime.now()
-        if file_name in blacklist:
-            continue
-        print(f'{file_name} -- detected')
-        if file_name[-3:] not in ['jpg', 'png']:
-            print(f'''{file_name} -- doesn't appear to be a jpeg or png, ignoring''')
-            blacklist.append(file_name)
-            continue
+# Parsed sidecar specs by path, with the modification time they were read at
+specs = {}
+
+def get_spec(file_name):
+    '''
+        A base image's spec: its sidecar (validated, and parsed once per
+        version of the file) if it has one, else dreamer_config.txt. Raises
+        ValueError for an invalid sidecar
+    '''
+    path = dream_base_dir + spec_file_name(file_name)
+    if not os.path.exists(path):
+        type, strength, artist = get_config()
+        return {'type' : type, 'strength' : strength, 'artist' : artist, 'budget' : None}
+    mtime = os.stat(path).st_mtime_ns
+    if path not in specs or specs[path][0] != mtime:
+        with open(path) as f:
+            try:
+                spec = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'spec is not valid JSON ({e})')
+        specs[path] = (mtime, check_dream_spec(spec))
+    return specs[path][1]
+
+class DreamJob:
+    # A claimed job on its way through prepare_dream, dream_job and save_job
+    def __init__(self, file_name, file_hash, type, strength, artist, budget = None, style = None):
+        self.file_name = file_name
+        self.file_hash = file_hash
+        self.type      = type
+        self.strength  = strength
+        self.artist    = artist
+        self.budget    = dream_budget if budget is None else budget
+        self.style     = style
+        self.start     = datetime.now()
+
+def prepare_dream(file_name):
+    '''
+        Decode stage: check the ledger, claim the job and load its image.
+        Returns the DreamJob, False if it should be retried later (its
+        style is not ready yet, or it failed with attempts left), or None
+        otherwise (nothing to do, or it has failed for good)
+    '''
+    path = dream_base_dir + file_name
+    if file_name.endswith(spec_suffix) or not os.path.exists(path):
+        return None
+    # A new spec (sidecar) for the same photo makes a new job
+    file_hash = hash_file(path, dream_base_dir + spec_file_name(file_name))
+    known     = ledger.known(file_name)
+    if ledger.enqueue(file_name, file_hash) in ['done', 'failed']:
+        return None
+    if not known and check_for_dream(file_name, dreamt_dir = dreamt_dir):
+        # Dreamt before the ledger existed
+        if ledger.start(file_name, file_hash, worker = worker_name):
+            ledger.finish(file_name, file_hash)
+        return None
+
+    print(f'{file_name} -- detected')
+    if file_name[-3:] not in ['jpg', 'png']:
+        print(f'''{file_name} -- doesn't appear to be a jpeg or png, ignoring''')
+        ledger.fail(file_name, file_hash, 'not a jpeg or png')
+        return None
+    try:
+        spec = get_spec(file_name)
+    except Exception as e:
+        print(f'{file_name} -- invalid spec: {e}')
+        ledger.fail(file_name, file_hash, f'invalid spec: {e}')
+        return None
+    type, strength, artist = spec['type'], spec['strength'], spec['artist']
+
+    style = None
+    if type == 'dream-style' and is_user_style(artist):
+        # An uploaded style image; its targets are extracted in the background
         try:
-            image, nat_size = load_lit_image(dream_base_dir+file_name, width, height)
+            style = user_styles.get(artist)
         except Exception as e:
-            print(f'''{file_name} -- error loading file''')
-            print(file_name, '--', e)
-            continue
+            print(f'{file_name} -- {e}')
+            ledger.fail(file_name, file_hash, e)
+            return None
+        if style is None:
+            print(f'{file_name} -- waiting for {artist} to be extracted')
+            return False
 
-        type, strength, artist = get_config()
-        print(f'{file_name} -- loaded, dreaming type: {type}; strength {strength}; artist {artist}')
-        if type == 'dream':
-            image = dream(model, image, *nat_size)
-        elif type == 'dream-style':
-            style = load_style(artist)
-            image = dream_style(style_model, image, style, *nat_size, strong = strength)
+    if not ledger.start(file_name, file_hash, spec, worker_name):
+        return None
+    job = DreamJob(file_name, file_hash, type, strength, artist, spec['budget'], style)
+    try:
+        if type == 'dream-style':
+            # Styled at the nearest bucket (aspect ratio, then size)
+            job.image, job.nat_size = load_lit_image(path, buckets = style_buckets)
+        else:
+            job.image, job.nat_size = load_lit_image(path, width, height)
+    except Exception as e:
+        print(f'''{file_name} -- error loading file''')
+        print(file_name, '--', e)
+        return False if fail_job(job, e) else None
+    return job
+
+def dream_job(job, on_preview = None):
+    # Dream stage (the only one that runs the models): returns the uint8 dream
+    file_name, image, nat_size, strength, artist = (
+        job.file_name, job.image, job.nat_size, job.strength, job.artist)
+    if job.type == 'dream-style' and artist == auto_artist:
+        artist = artist_ranker.closest(image)
+    print(f'{file_name} -- loaded, dreaming type: {job.type}; strength {strength}; artist {artist}')
+    dream_start = datetime.now()
+    if job.type == 'dream':
+        image = dream(model, image, *nat_size, budget = job.budget)
+    elif job.type == 'dream-style' and use_style_transforms and style_transforms.available(artist):
+        image = transform_style(style_transforms.get(artist), image, *nat_size, strong = strength)
+    elif job.type == 'dream-style':
+        style = job.style or load_style(artist)
+        style_model  = style_models.get(image.shape[1:3])
+        coarse_model = None
+        if coarse_to_fine and coarse_bucket(image.shape[1:3]) is not None:
+            coarse_model = style_models.get(coarse_bucket(image.shape[1:3]))
+        image = dream_style(style_model, image, style, *nat_size, strong = strength,
+                            budget = job.budget, on_preview = on_preview, coarse_model = coarse_model)
+    dream_time = (datetime.now() - dream_start).total_seconds()
+    print(f'{file_name} -- dreamt in {dream_time:.2f}s')
+    if job.type == 'dream-style':
+        print(f'{file_name} -- style cache {style_store.stats()}')
+    return image
+
+def save_job(job, image):
+    # Encode stage: write the dream and close the job
+    print(f'{job.file_name} -- saving')
+    save_dream(image, job.file_name)
+    ledger.finish(job.file_name, job.file_hash)
+    specs.pop(dream_base_dir + spec_file_name(job.file_name), None)
+    time_elapsed = (datetime.now() - job.start).seconds
+    print(f'{job.file_name} -- {time_elapsed}s elapsed')
+
+# Errors raised preparing each file (before its job could be claimed)
+prepare_errors = {}
+prepare_lock   = threading.Lock()
+
+def try_prepare(file_name):
+    '''
+        prepare_dream, but an error it raises is retried (False) until the
+        file has used up the ledger's max_attempts; then its queued job is
+        failed (None)
+    '''
+    try:
+        job = prepare_dream(file_name)
+    except Exception as e:
+        print(f'{file_name} -- error preparing: {e}')
+        with prepare_lock:
+            prepare_errors[file_name] = prepare_errors.get(file_name, 0) + 1
+            if prepare_errors[file_name] < ledger.max_attempts:
+                return False
+            del prepare_errors[file_name]
+        ledger.fail_queued(file_name, e)
+        return None
+    with prepare_lock:
+        prepare_errors.pop(file_name, None)
+    return job
+
+def fail_job(job, error):
+    # Record a failure; True if the job has attempts left (retry it later)
+    return ledger.fail(job.file_name, job.file_hash, error, retry = True) == 'queued'
+
+def process_dream(file_name):
+    '''
+        Dream one base image, start to finish. Returns False if it should
+        be retried later, True otherwise
+    '''
+    job = try_prepare(file_name)
+    if job is None or job is False:
+        return job is None
+    try:
+        image = dream_job(job, lambda preview : save_preview(preview, job.file_name))
+        save_job(job, image)
+    except Exception as e:
+        print(f'{file_name} -- error dreaming: {e}')
+        return not fail_job(job, e)
+    return True
+
+class DreamPipeline:
+    '''
+        Decode, dream and encode in overlapping stages
+
+        decode_workers threads take names from the job queue and load
+        them, the calling thread dreams (it alone runs the models), and
+        encode_workers threads write the dreams and previews. A decode
+        thread only takes a name once there is room for its job, so at most
+        max_queued jobs are claimed and loaded ahead of the dreamer (others
+        sharing the job queue get the rest), and at most max_queued writes
+        wait, so nothing piles up in memory. A None from the job queue stops
+        run(), once the writes in hand are done (jobs decoded after it stay
+        claimed; see JobLedger.recover).
+    '''
+    def __init__(self, jobs, decode_workers = 2, encode_workers = 2, max_queued = 2):
+        self.jobs    = jobs
+        self.slots   = threading.Semaphore(max_queued)
+        self.decoded = queue.Queue()
+        self.writes  = queue.Queue(maxsize = max_queued)
+        self.threads = ([threading.Thread(target = self.decode, daemon = True) for _ in range(decode_workers)] +
+                        [threading.Thread(target = self.encode, daemon = True) for _ in range(encode_workers)])
+
+    def retry(self, file_name):
+        threading.Timer(retry_delay, self.jobs.put, [file_name]).start()
+
+    def decode(self):
+        while True:
+            self.slots.acquire()
+            file_name = self.jobs.get()
+            if file_name is None:
+                self.decoded.put(None)
+                return
+            job = try_prepare(file_name)
+            if job is False:
+                self.retry(file_name)
+            if job is None or job is False:
+                self.slots.release()
+            else:
+                self.decoded.put(job)
+
+    def encode(self):
+        while True:
+            write = self.writes.get()
+            try:
+                write()
+            except Exception as e:
+                print(f'Error writing a preview: {e}')
+            finally:
+                self.writes.task_done()
+
+    def run(self):
+        for thread in self.threads:
+            thread.start()
+        while True:
+            job = self.decoded.get()
+            if job is None:
+                self.writes.join()
+                return
+            self.slots.release()
+            try:
+                on_preview = lambda preview, job = job : self.writes.put(
+                    lambda : save_preview(preview, job.file_name))
+                image = dream_job(job, on_preview)
+            except Exception as e:
+                self.failed(job, 'dreaming', e)
+                continue
+            self.writes.put(lambda job = job, image = image : self.save(job, image))
+
+    def save(self, job, image):
+        try:
+            save_job(job, image)
+        except Exception as e:
+            self.failed(job, 'saving', e)
+
+    def failed(self, job, stage, error):
+        # Record the failure and retry if attempts remain. Never raises: an
+        #  error here (e.g. from the ledger) must not stop the pipeline
+        try:
+            print(f'{job.file_name} -- error {stage}: {error}')
+            if fail_job(job, error):
+                self.retry(job.file_name)
+        except Exception as e:
+            print(f'Error recording a failed job: {e}')
+
+# Loaded by load_models (not on import, so worker processes can set up
+#  TensorFlow's threads first)
+model = width = height = None
+
+def load_models():
+    global model, width, height
+    model, width, height = load_dream_model()
+    # width = height = 896
+
+# Long enough that warming the budgeted path never stops it early
+warm_up_budget = 3600
 
-        print(f'{file_name} -- saving')
-        save_dream(image, file_name)
+def warm_up():
+    # Pay for graph construction and first-run kernel setup at start up,
+    #  rather than on the first visitor's photo
+    start = datetime.now()
+    # Both the fixed-step path and the budgeted one (specs may set a budget)
+    image = tf.zeros([1, width, height, 3])
+    dream(model, image, width, height)
+    dream(model, image, width, height, budget = warm_up_budget)
+    style = load_style('Pablo Picasso')
+    for bucket in style_buckets:
+        style_model  = style_models.get(bucket)
+        bucket_image = tf.zeros([1, *bucket, 3])
+        dream_style(style_model, bucket_image, style, *bucket)
+        dream_style(style_model, bucket_image, style, *bucket, budget = warm_up_budget)
+    warm_time = (datetime.now() - start).total_seconds()
+    print(f'Models traced and warmed in {warm_time:.2f}s')
 
-        time_elapsed = (datetime.now() - start).seconds
-        print(f'{file_name} -- {time_elapsed}s elapsed')
+    # Every artist's style targets, as views of the pack (shared with any
+    #  other process serving from it)
+    style_store.preload(class_names)
+    print(f'Styles preloaded: {style_store.stats()}')
+    artist_ranker.closest(image)
 
-model, width, height = load_dream_model()
-style_model          = load_dream_style_model()
-# width = height = 896
+# Delay (seconds) before retrying a job that is waiting on its style
+retry_delay = 1.0
 
 def main():
+    load_models()
+    warm_up()
+    jobs    = JobQueue()
+    watcher = Watcher(dream_base_dir, jobs, 'remote-watcher')
+    watcher.start()
+    # Jobs cut off by a crash, jobs still queued, and anything that arrived
+    #  while the server was down
+    for file_name in ledger.recover():
+        print(f'{file_name} -- interrupted, queued again')
+    for file_name in ledger.pending() + get_undreamt_files(dream_base_dir, dreamt_dir):
+        jobs.put(file_name)
+    print(f'Jobs: {ledger.counts()}')
     print(f'\n-----------------------------------------\n'
         f'Watcher remote-watcher all set up')
-    while True:
-        process_new_dreams()
-        time.sleep(5)
+    try:
+        DreamPipeline(jobs).run()
+    finally:
+        watcher.stop()
 
 if __name__ == '__main__':
     main()
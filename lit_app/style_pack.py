@@ -0,0 +1,122 @@
+'''
+    Compact single-file format for every artist's Gram targets
+
+    Gram matrices are symmetric, so only the upper triangles are stored
+    (float32, about 1.2MB per artist), back to back in one file after a
+    JSON index. They are in the form the style model takes, so the file is
+    memory-mapped and the triangles are read from it in place: processes
+    reading it share its pages (see StyleStore).
+
+    Layout: 8 byte little-endian index length, the JSON index, padding to
+    a 64 byte boundary, then the data, each triangle starting on a 64 byte
+    boundary. The index records the dtype and, per artist, the (offset,
+    size) of each layer's triangle.
+
+    To convert the existing npz files (float16 packs, as written before,
+    are no longer read; rebuild them this way or with extract_styles.py):
+        python style_pack.py
+'''
+
+import numpy as np
+import json
+import glob
+import os
+
+style_dir  = '../dreaming/style-activations/'
+style_pack = '../dreaming/style-activations.pack'
+
+ALIGNMENT = 64
+
+def npz_triangles(npz_path):
+    # Layers in the order they were saved (arr_0, arr_1, ...), as triangles
+    #  (the npz files hold full (1, n, n) Gram matrices)
+    with np.load(npz_path, allow_pickle = False) as style_data:
+        names = sorted(style_data.files, key = lambda name : int(name.split('_')[-1]))
+        return [as_triangle(style_data[name]) for name in names]
+
+def as_triangle(gram):
+    # A Gram matrix's upper triangle; triangles are returned flat, as they are
+    gram = np.asarray(gram, dtype = np.float32)
+    if gram.ndim == 1 or gram.shape[-2:] != (gram.shape[-1], gram.shape[-1]):
+        return gram.reshape(-1)
+    gram = gram.reshape(gram.shape[-2:])
+    return gram[np.triu_indices(gram.shape[0])]
+
+def pack_style_activations(style_dir = style_dir, out_path = style_pack):
+    targets = {}
+    for npz_path in sorted(glob.glob(f'{style_dir}*.npz')):
+        artist = os.path.basename(npz_path)[:-len('.npz')]
+        targets[artist] = npz_triangles(npz_path)
+    return write_pack(targets, out_path)
+
+def write_pack(targets, out_path = style_pack):
+    # targets maps each artist to its list of triangles (or Gram matrices),
+    #  in layer order
+    index  = {'dtype' : 'float32', 'artists' : {}}
+    chunks = []
+    offset = 0
+    for artist in sorted(targets):
+        layers = []
+        for target in targets[artist]:
+            triangle = as_triangle(target)
+            chunk    = triangle.tobytes()
+            chunk   += b'\0' * (-len(chunk) % ALIGNMENT)
+            layers.append({'offset' : offset, 'size' : triangle_size(len(triangle))})
+            chunks.append(chunk)
+            offset += len(chunk)
+        index['artists'][artist] = layers
+
+    # Write beside the target and rename, so readers never see half a file
+    header   = json.dumps(index).encode()
+    start    = -(-(8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(b'\0' * (start - 8 - len(header)))
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def triangle_size(length):
+    # n, for a triangle of n(n+1)/2 entries
+    return int(round(((8 * length + 1) ** 0.5 - 1) / 2))
+
+class PackedStyles:
+    '''
+        View of a packed style file
+
+        triangles() returns float32 arrays straight onto the memory map (no
+        copy). The map is copy-on-write, so the arrays are writable (which
+        DLPack needs to hand them to TensorFlow), but nothing writes them
+        and the file is never changed.
+    '''
+    def __init__(self, path = style_pack):
+        self.data   = np.memmap(path, dtype = np.uint8, mode = 'c')
+        header_size = int(self.data[:8].view(np.uint64)[0])
+        index       = json.loads(self.data[8:8 + header_size].tobytes())
+        self.start  = -(-(8 + header_size) // ALIGNMENT) * ALIGNMENT
+        self.dtype  = np.dtype(index['dtype'])
+        self.index  = index['artists']
+        if self.dtype != np.float32:
+            raise ValueError(f'{path} holds {self.dtype} targets; re-pack it as float32 '
+                             f'(python style_pack.py, or extract_styles.py)')
+
+    def __contains__(self, artist):
+        return artist in self.index
+
+    def artists(self):
+        return list(self.index)
+
+    def triangles(self, artist):
+        triangles = []
+        for layer in self.index[artist]:
+            count  = layer['size'] * (layer['size'] + 1) // 2
+            offset = self.start + layer['offset']
+            triangles.append(np.frombuffer(self.data, self.dtype, count, offset))
+        return triangles
+
+if __name__ == '__main__':
+    out_path = pack_style_activations()
+    print(f'Packed {style_dir} into {out_path} ({os.path.getsize(out_path) / 2**20:.1f}MB)')
@@ -0,0 +1,92 @@
+'''
+    Process-wide, in-memory store of per-artist style targets
+'''
+
+import tensorflow as tf
+import numpy as np
+import os
+from collections import OrderedDict
+
+import sys
+sys.path.append('../utilities')
+from utilities import dummy
+from style_pack import PackedStyles, npz_triangles, style_dir, style_pack
+
+# Caps the copies of targets read from npz files (about 1.2MB per artist);
+#  targets in the pack are shared and not counted
+max_style_bytes = 256 * 2**20
+
+def shared_tensor(array):
+    # A tensor on array's memory (no copy), through DLPack
+    return tf.experimental.dlpack.from_dlpack(array.__dlpack__())
+
+class StyleStore:
+    '''
+        Style model inputs by artist: the tuple (dummy, *gram_triangles)
+
+        Artists in the pack are served straight from its memory map: the
+        tensors are made on the mapped pages, so nothing is copied or
+        expanded, and every process serving from the pack shares one copy
+        (in the page cache). Those tuples are kept, costing nothing more.
+        Artists only found as npz files are loaded into an LRU of this
+        process's own copies, evicted least recently used first once
+        max_bytes is exceeded (the most recent entry is always kept). hits
+        and misses count lookups.
+    '''
+    def __init__(self, max_bytes = max_style_bytes, style_dir = style_dir, pack_path = style_pack):
+        self.max_bytes = max_bytes
+        self.style_dir = style_dir
+        self.packed    = PackedStyles(pack_path) if os.path.exists(pack_path) else None
+        self.shared    = {}
+        self.styles    = OrderedDict()
+        self.sizes     = {}
+        self.hits      = 0
+        self.misses    = 0
+
+    def load(self, artist):
+        if self.packed is not None and artist in self.packed:
+            style_inputs = [shared_tensor(triangle[np.newaxis]) for triangle in self.packed.triangles(artist)]
+        else:
+            style_path   = f'{self.style_dir}{artist}.npz'
+            style_inputs = [tf.convert_to_tensor(triangle[np.newaxis]) for triangle in npz_triangles(style_path)]
+        return tuple([dummy] + style_inputs)
+
+    def get(self, artist):
+        if artist in self.shared:
+            self.hits += 1
+            return self.shared[artist]
+        if artist in self.styles:
+            self.hits += 1
+            self.styles.move_to_end(artist)
+            return self.styles[artist]
+
+        self.misses += 1
+        inputs = self.load(artist)
+        if self.packed is not None and artist in self.packed:
+            self.shared[artist] = inputs
+        else:
+            self.styles[artist] = inputs
+            self.sizes[artist]  = sum(tensor.numpy().nbytes for tensor in inputs)
+            self.evict()
+        return inputs
+
+    def evict(self):
+        while self.num_bytes() > self.max_bytes and len(self.styles) > 1:
+            artist, _ = self.styles.popitem(last = False)
+            del self.sizes[artist]
+
+    def num_bytes(self):
+        return sum(self.sizes.values())
+
+    def preload(self, artists):
+        for artist in artists:
+            self.get(artist)
+
+    def stats(self):
+        # bytes counts this process's own copies
+        return {'artists' : len(self.shared) + len(self.styles),
+                'bytes'   : self.num_bytes(),
+                'hits'    : self.hits,
+                'misses'  : self.misses}
+
+style_store = StyleStore()
@@ -0,0 +1,232 @@
+'''
+    Feed-forward style transfer: one small network per artist
+
+    Each network is trained to restyle any photo in a single forward pass.
+    Its loss is the style model's own (the artist's Gram targets plus the
+    dream term, through the same VGG19 layers), plus a content term that
+    keeps the photo recognisable, which the iterative path gets from
+    starting at the photo and taking only a few steps.
+
+    Train (weights land in transform_dir, and are served once present):
+        python style_transform.py "Pablo Picasso" [steps]
+'''
+
+import tensorflow as tf
+import os
+from datetime import datetime
+from collections import OrderedDict
+
+from tensorflow.keras.layers import (
+    Lambda, Conv2D, UpSampling2D, Activation, Add, Input, InputLayer, MaxPooling2D, AvgPool2D
+)
+from tensorflow.keras.models import Model
+
+from remote_dreamer_in_style import (
+    load_base_model,
+    style_layers,
+    output_layer_weights,
+    style_content_weighting,
+)
+from style_store import style_store
+
+import sys
+sys.path.append('../utilities')
+from utilities import (
+    vgg19_process_image,
+    gram_matrix,
+    gram_distance,
+    deprocess_dream,
+    InstanceNormalization,
+)
+
+transform_dir   = '../dreaming/style-transforms/'
+# Photos to train on (any images will do; the artworks are at hand)
+content_pattern = '../dataset/images/train/*/*.jpg'
+content_layer   = 'block4_conv1'
+# Relative to the style model's loss; raise it to keep more of the photo
+content_weight  = 1e4
+crop_size       = 256
+batch_size      = 4
+learning_rate   = 1e-3
+max_transforms  = 4
+
+def build_transform_net(filters = (32, 64, 128), residual_blocks = 5):
+    '''
+        Image to image network (Johnson et al. 2016): two strided
+        convolutions down, residual blocks, two upsampling convolutions
+        back. Takes and returns vgg19 pre-processed images of any size
+        divisible by 4
+    '''
+    def conv(signal, filters, kernel_size, strides = 1, activation = 'relu'):
+        signal = Conv2D(filters, kernel_size, strides = strides, padding = 'same')(signal)
+        signal = InstanceNormalization()(signal)
+        if activation is not None:
+            signal = Activation(activation)(signal)
+        return signal
+
+    input_ = Input(shape = (None, None, 3))
+    signal = Lambda(lambda image : image / 150.)(input_)
+    signal = conv(signal, filters[0], 9)
+    signal = conv(signal, filters[1], 3, strides = 2)
+    signal = conv(signal, filters[2], 3, strides = 2)
+    for block in range(residual_blocks):
+        residual = conv(signal, filters[2], 3)
+        residual = conv(residual, filters[2], 3, activation = None)
+        signal   = Add()([signal, residual])
+    for size in [filters[1], filters[0]]:
+        signal = UpSampling2D()(signal)
+        signal = conv(signal, size, 3)
+    signal = Conv2D(3, 9, padding = 'same', activation = 'tanh')(signal)
+    # The range the style model's RemainImage constraint allows
+    output = Lambda(lambda image : image * 150.)(signal)
+    return Model(inputs = [input_], outputs = [output], name = 'style_transform')
+
+def load_loss_network(base_model = None):
+    '''
+        The style model's layers on an image input. Returns the Gram
+        matrices of style_layers, the activations of the weighted output
+        layers and the content layer's activations, in that order
+    '''
+    if base_model is None:
+        base_model = load_base_model()
+    output_names = [name for name in output_layer_weights if name in
+                    [layer.name for layer in base_model.layers]]
+    needed  = set(style_layers) | set(output_names) | {content_layer}
+
+    input_  = Input(shape = (None, None, 3))
+    signal  = input_
+    found   = {}
+    for layer in base_model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        elif isinstance(layer, MaxPooling2D):
+            layer = AvgPool2D().from_config(layer.get_config())
+        layer.trainable = False
+        signal = layer(signal)
+        if layer.name in needed:
+            found[layer.name] = signal
+        if len(found) == len(needed):
+            break
+
+    grams   = [Lambda(gram_matrix, name = f'gram_{name}')(found[name]) for name in style_layers]
+    outputs = grams + [found[name] for name in output_names] + [found[content_layer]]
+    return Model(inputs = [input_], outputs = outputs, name = 'loss_network'), output_names
+
+def content_dataset(pattern = content_pattern, crop_size = crop_size, batch_size = batch_size):
+    def decode(path):
+        image = tf.io.read_file(path)
+        image = tf.image.decode_jpeg(image, channels = 3)
+        # Shrink so the short side is about the crop size, then crop
+        shape = tf.cast(tf.shape(image)[:2], tf.float32)
+        scale = (crop_size * 1.15) / tf.reduce_min(shape)
+        image = tf.image.resize(tf.cast(image, tf.float32), tf.cast(shape * scale, tf.int32))
+        image = tf.image.random_crop(image, [crop_size, crop_size, 3])
+        return vgg19_process_image(image)
+
+    ds = tf.data.Dataset.list_files(pattern, shuffle = True)
+    ds = ds.map(decode, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+    ds = ds.apply(tf.data.experimental.ignore_errors())
+    return ds.repeat().batch(batch_size, drop_remainder = True).prefetch(tf.data.experimental.AUTOTUNE)
+
+def transform_path(artist):
+    return f'{transform_dir}{artist}.h5'
+
+class TransformTrainer:
+    '''
+        Trains one artist's transform network with Adam against the style
+        model's loss (see the module docstring). The loss network is frozen
+    '''
+    def __init__(self, artist, loss_network = None, content_weight = content_weight,
+                 learning_rate = learning_rate):
+        # loss_network (optional) is what load_loss_network returns, to share
+        #  one between trainers
+        self.artist       = artist
+        self.net          = build_transform_net()
+        self.loss_network, self.output_names = loss_network or load_loss_network()
+        self.targets      = style_store.get(artist)[1:]
+        self.content_weight = content_weight
+        self.optimizer    = tf.optimizers.Adam(learning_rate = learning_rate)
+        self.style_weight = 1/len(style_layers) * style_content_weighting * (1/4)
+
+    def losses(self, photos, stylised):
+        # Per image, as the style model computes them (its batch of one)
+        num_style  = len(style_layers)
+        features   = self.loss_network(stylised)
+        style_loss = tf.add_n([
+            gram_distance(target, gram) * self.style_weight
+            for target, gram in zip(self.targets, features[:num_style])])
+        dream_loss = tf.add_n([
+            -tf.reduce_mean(activation, axis = [1, 2, 3]) * output_layer_weights[name]
+            for name, activation in zip(self.output_names, features[num_style:-1])])
+        content    = self.loss_network(photos)[-1]
+        content_loss = tf.reduce_mean(tf.square(features[-1] - content), axis = [1, 2, 3])
+        return style_loss, dream_loss, content_loss * self.content_weight
+
+    @tf.function
+    def train_step(self, photos):
+        with tf.GradientTape() as tape:
+            losses = self.losses(photos, self.net(photos, training = True))
+            loss   = tf.reduce_mean(tf.add_n(losses))
+        gradients = tape.gradient(loss, self.net.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.net.trainable_variables))
+        return [tf.reduce_mean(part) for part in losses]
+
+    def train(self, steps, dataset = None, log_every = 100, save_every = 1000):
+        if dataset is None:
+            dataset = content_dataset()
+        start   = datetime.now()
+        for step, photos in enumerate(dataset.take(steps), start = 1):
+            style_loss, dream_loss, content_loss = self.train_step(photos)
+            if step % log_every == 0 or step == steps:
+                seconds = (datetime.now() - start).total_seconds()
+                print(f'{self.artist} -- step {step}/{steps}: style {float(style_loss):.4g}, '
+                      f'dream {float(dream_loss):.4g}, content {float(content_loss):.4g} '
+                      f'({seconds / step:.2f}s/step)')
+            if step % save_every == 0 or step == steps:
+                self.save()
+
+    def save(self):
+        os.makedirs(transform_dir, exist_ok = True)
+        self.net.save_weights(transform_path(self.artist))
+
+class StyleTransforms:
+    '''
+        Trained transform networks, loaded on first use; the max_transforms
+        most recently used are kept
+    '''
+    def __init__(self, max_transforms = max_transforms):
+        self.max_transforms = max_transforms
+        self.nets = OrderedDict()
+
+    def available(self, artist):
+        return artist in self.nets or os.path.exists(transform_path(artist))
+
+    def get(self, artist):
+        if artist in self.nets:
+            self.nets.move_to_end(artist)
+            return self.nets[artist]
+
+        net = build_transform_net()
+        net.load_weights(transform_path(artist))
+        self.nets[artist] = net
+        while len(self.nets) > self.max_transforms:
+            self.nets.popitem(last = False)
+        return net
+
+style_transforms = StyleTransforms()
+
+def transform_style(net, image, nat_width, nat_height, strong = False):
+    # One forward pass in place of dream_style's optimisation. The weak
+    #  version goes half way from the photo to the full stylisation
+    stylised = net(image)
+    if not strong:
+        stylised = image + 0.5 * (stylised - image)
+    img = deprocess_dream(stylised.numpy())
+    img = tf.image.resize(img, [nat_width, nat_height], method = 'gaussian')
+    img = tf.cast(img, tf.uint8)
+    return img
+
+if __name__ == '__main__':
+    artist = sys.argv[1]
+    steps  = int(sys.argv[2]) if len(sys.argv) > 2 else 40000
+    TransformTrainer(artist).train(steps)
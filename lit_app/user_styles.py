@@ -0,0 +1,170 @@
+'''
+    Style targets for style images uploaded by users
+
+    The app posts a style image to user_style_dir and names it in the
+    config as user_style_prefix + file name. Its Gram targets are
+    extracted once, in batches on a background thread (so dreams already
+    running are never held up), and cached on disk by the hash of the
+    image's contents, so re-uploads and repeat requests are free. The
+    disk cache is capped at max_cache_bytes, least recently used first.
+'''
+
+import tensorflow as tf
+import numpy as np
+import hashlib
+import threading
+import glob
+import os
+from collections import OrderedDict
+from datetime import datetime
+
+from extract_styles import load_style_extractor
+from style_pack     import npz_triangles
+
+import sys
+sys.path.append('../utilities')
+from utilities import (
+    load_image,
+    vgg19_process_image,
+    upper_triangle,
+    dummy,
+)
+
+user_style_prefix  = 'style-image:'
+user_style_dir     = '../style-images/'
+user_style_cache   = '../dreaming/user-styles/'
+max_cache_bytes    = 2**30
+extract_batch_size = 4
+# Extracted styles also kept in memory, most recently used
+max_memory_styles  = 8
+
+def is_user_style(artist):
+    return artist.startswith(user_style_prefix)
+
+def content_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:32]
+
+class UserStyles:
+    '''
+        get(artist) returns the style model inputs for an uploaded style
+        image, or None if they are still being extracted (the extraction is
+        queued). Raises ValueError for images that could not be read
+    '''
+    def __init__(self, image_dir = user_style_dir, cache_dir = user_style_cache,
+                 max_bytes = max_cache_bytes, batch_size = extract_batch_size):
+        self.image_dir  = image_dir
+        self.cache_dir  = cache_dir
+        self.max_bytes  = max_bytes
+        self.batch_size = batch_size
+        self.styles     = OrderedDict()
+        self.pending    = OrderedDict()
+        self.failed     = {}
+        self.lock       = threading.Lock()
+        self.wake       = threading.Event()
+        self.thread     = None
+        self.extractor  = None
+
+    def cache_path(self, key):
+        return f'{self.cache_dir}{key}.npz'
+
+    def get(self, artist):
+        path = self.image_dir + artist[len(user_style_prefix):]
+        key  = content_hash(path)
+        # Called from several decode threads at once
+        with self.lock:
+            if key in self.failed:
+                raise ValueError(f'{artist} -- could not extract a style ({self.failed[key]})')
+            if key in self.styles:
+                self.styles.move_to_end(key)
+                return self.styles[key]
+
+        cache_path = self.cache_path(key)
+        try:
+            # Touch it: eviction goes by modification time
+            os.utime(cache_path)
+            inputs = tuple([dummy] + [tf.convert_to_tensor(triangle[np.newaxis])
+                                      for triangle in npz_triangles(cache_path)])
+        except FileNotFoundError:
+            # Not extracted yet (or evicted since)
+            self.request(key, path)
+            return None
+
+        with self.lock:
+            self.styles[key] = inputs
+            while len(self.styles) > max_memory_styles:
+                self.styles.popitem(last = False)
+        return inputs
+
+    def request(self, key, path):
+        with self.lock:
+            self.pending[key] = path
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = 'user-styles', daemon = True)
+                self.thread.start()
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                batch = list(self.pending.items())[:self.batch_size]
+                if len(batch) == len(self.pending):
+                    self.wake.clear()
+            if not batch:
+                continue
+            try:
+                self.extract(batch)
+            except Exception as e:
+                # Fail the batch, not the thread: later requests still get served
+                print(f'Error extracting {len(batch)} style image(s): {e}')
+                with self.lock:
+                    for key, _ in batch:
+                        self.failed[key] = str(e)
+            with self.lock:
+                for key, _ in batch:
+                    self.pending.pop(key, None)
+
+    def extract(self, batch):
+        if self.extractor is None:
+            self.extractor = load_style_extractor()
+        width, height = self.extractor.input_shape[1:3]
+
+        start  = datetime.now()
+        keys   = []
+        images = []
+        for key, path in batch:
+            try:
+                image = vgg19_process_image(load_image(path))
+                images.append(tf.image.resize(image, (width, height)))
+                keys.append(key)
+            except Exception as e:
+                print(f'{path} -- error loading style image: {e}')
+                with self.lock:
+                    self.failed[key] = str(e)
+        if not images:
+            return
+
+        grams = self.extractor(tf.stack(images))
+        if not isinstance(grams, list):
+            grams = [grams]
+        os.makedirs(self.cache_dir, exist_ok = True)
+        for index, key in enumerate(keys):
+            tmp_path = self.cache_path(key) + '.tmp.npz'
+            np.savez(tmp_path, *[upper_triangle(gram[index:index + 1]).numpy() for gram in grams])
+            os.replace(tmp_path, self.cache_path(key))
+        seconds = (datetime.now() - start).total_seconds()
+        print(f'Extracted {len(keys)} style image(s) in {seconds:.2f}s')
+        self.evict()
+
+    def evict(self):
+        paths = sorted(glob.glob(f'{self.cache_dir}*.npz'), key = os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in paths)
+        # The newest is always kept
+        for path in paths[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+user_styles = UserStyles()
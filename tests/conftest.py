@@ -0,0 +1,12 @@
+# The apps import their modules off sys.path and read paths relative to
+#  lit_app/ (see lit_app/remote_watcher.py), so the tests run from there
+import os
+import sys
+
+# The models are tf.keras (Keras 2) models
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.join(root, 'lit_app'))
+sys.path[:0] = [os.path.join(root, 'lit_app'), os.path.join(root, 'utilities')]
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+import app_utilities
+from app_utilities import auto_artist, check_dream_spec, user_style_prefix
+
+def test_normalises_a_valid_spec():
+    spec = check_dream_spec({'type' : 'dream-style', 'artist' : 'Albrecht Durer'})
+    assert spec == {'type' : 'dream-style', 'strength' : True, 'artist' : 'Albrecht Durer', 'budget' : None}
+
+def test_matches_artists_with_or_without_padding():
+    for name in ('Wassily Kandinsky', ' Wassily Kandinsky'):
+        spec = check_dream_spec({'type' : 'dream-style', 'artist' : name, 'strength' : False, 'budget' : 30})
+        assert spec['artist'] == ' Wassily Kandinsky'
+        assert spec['strength'] is False and spec['budget'] == 30
+
+def test_accepts_auto_and_user_styles():
+    assert check_dream_spec({'type' : 'dream-style', 'artist' : auto_artist})['artist'] == auto_artist
+    style = user_style_prefix + 'abc123.jpg'
+    assert check_dream_spec({'type' : 'dream-style', 'artist' : style})['artist'] == style
+
+@pytest.mark.parametrize('spec', [
+    ['dream'],
+    {'type' : 'dream', 'colour' : 'blue'},
+    {'type' : 'nightmare'},
+    {'type' : 'dream', 'strength' : 'strong'},
+    {'type' : 'dream', 'strength' : 1},
+    {'type' : 'dream-style', 'artist' : 'Nobody'},
+    {'type' : 'dream-style', 'artist' : 7},
+    {'type' : 'dream-style', 'artist' : user_style_prefix + '../secrets.jpg'},
+    {'type' : 'dream', 'budget' : True},
+    {'type' : 'dream', 'budget' : 0},
+    {'type' : 'dream', 'budget' : -5},
+    {'type' : 'dream', 'budget' : '30'},
+])
+def test_rejects_bad_specs(spec):
+    with pytest.raises(ValueError):
+        check_dream_spec(spec)
+
+def test_snapshot_keeps_the_spec_of_arrival(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_utilities, 'local_spec_dir', str(tmp_path / 'specs') + '/')
+    selected = str(tmp_path / 'dream-spec.json')
+    assert app_utilities.snapshot_dream_spec('a.jpg', path = selected) is None
+
+    app_utilities.save_dream_spec('dream', strong = False, path = selected)
+    spec_path = app_utilities.snapshot_dream_spec('a.jpg', path = selected)
+    app_utilities.save_dream_spec('dream-style', path = selected)
+    # A later selection does not change the photo's copy
+    assert app_utilities.snapshot_dream_spec('a.jpg', path = selected) == spec_path
+    with open(spec_path) as f:
+        assert json.load(f)['type'] == 'dream'
@@ -0,0 +1,27 @@
+import numpy as np
+import tensorflow as tf
+
+from deep_dream import bucket_shape, pad_to_bucket
+
+def test_bucket_shape_rounds_up():
+    assert bucket_shape((64, 65)) == (64, 128)
+    assert bucket_shape((1, 200), multiple = 32) == (32, 224)
+
+def test_pads_by_reflecting():
+    img = tf.reshape(tf.range(6, dtype = tf.float32), [2, 3, 1]) * tf.ones([1, 1, 3])
+    padded, mask = pad_to_bucket(img, (4, 4))
+    assert padded.shape == (4, 4, 3) and mask.shape == (4, 4, 1)
+    np.testing.assert_array_equal(padded[:2, :3], img)
+    # Mirrored about the edge
+    np.testing.assert_array_equal(padded[2:, :3], img[::-1])
+    np.testing.assert_array_equal(padded[:2, 3], img[:, 2])
+    assert float(tf.reduce_sum(mask)) == 6 and float(tf.reduce_sum(mask[:2, :3])) == 6
+
+def test_pads_images_smaller_than_the_padding():
+    img = tf.random.uniform([20, 5, 3])
+    bucket = bucket_shape(img.shape[:2])
+    padded, mask = pad_to_bucket(img, bucket)
+    assert padded.shape == (64, 64, 3) and mask.shape == (64, 64, 1)
+    np.testing.assert_array_equal(padded[:20, :5], img)
+    np.testing.assert_array_equal(padded[20:40, :5], img[::-1])
+    assert float(tf.reduce_sum(mask)) == 100
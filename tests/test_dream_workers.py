@@ -0,0 +1,34 @@
+import sys
+import time
+
+import dream_workers
+from dream_workers import DreamWorkers
+from job_ledger import JobLedger
+
+class FailingWorkers(DreamWorkers):
+    # Workers that exit as soon as they start
+    def start_worker(self, index):
+        process = self.context.Process(target = sys.exit, args = (3,), name = f'dream-worker-{index}')
+        process.start()
+        self.workers[index] = process
+        self.started[index] = time.time()
+
+def test_gives_up_on_a_worker_that_keeps_dying(tmp_path, monkeypatch):
+    monkeypatch.setattr(dream_workers, 'monitor_interval', 0.01)
+    monkeypatch.setattr(dream_workers, 'restart_delay', 0.2)
+    monkeypatch.setattr(dream_workers, 'max_restarts', 3)
+    pool = FailingWorkers(1)
+    pool.ledger = JobLedger(str(tmp_path / 'jobs.sqlite'))
+    starts = []
+    start_worker = pool.start_worker
+    def recorded(index):
+        starts.append(time.time())
+        start_worker(index)
+    pool.start_worker = recorded
+
+    pool.start_worker(0)
+    pool.monitor()
+    assert pool.workers == [None] and len(starts) == 4
+    # Each restart waits twice as long as the last
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    assert gaps[0] >= 0.2 and gaps[1] >= 0.4 and gaps[2] >= 0.8
@@ -0,0 +1,79 @@
+import pytest
+
+from job_ledger import JobLedger, hash_file
+
+@pytest.fixture
+def ledger(tmp_path):
+    return JobLedger(str(tmp_path / 'jobs.sqlite'), max_attempts = 2)
+
+def test_runs_a_job_to_done(ledger):
+    assert ledger.enqueue('a.jpg', 'h') == 'queued'
+    assert ledger.pending() == ['a.jpg']
+    assert ledger.start('a.jpg', 'h', {'type' : 'dream'}, 'worker-0')
+    # Claimed once only
+    assert not ledger.start('a.jpg', 'h')
+    ledger.finish('a.jpg', 'h')
+    job = ledger.job('a.jpg', 'h')
+    assert job['state'] == 'done' and job['params'] == {'type' : 'dream'} and job['worker'] == 'worker-0'
+    assert ledger.enqueue('a.jpg', 'h') == 'done'
+    assert ledger.pending() == []
+
+def test_retries_until_attempts_run_out(ledger):
+    ledger.enqueue('a.jpg', 'h')
+    ledger.start('a.jpg', 'h')
+    assert ledger.fail('a.jpg', 'h', 'boom', retry = True) == 'queued'
+    ledger.start('a.jpg', 'h')
+    assert ledger.fail('a.jpg', 'h', 'boom', retry = True) == 'failed'
+    assert ledger.job('a.jpg', 'h')['error'] == 'boom'
+    assert not ledger.start('a.jpg', 'h')
+
+def test_fails_without_retry(ledger):
+    ledger.enqueue('a.jpg', 'h')
+    ledger.start('a.jpg', 'h')
+    assert ledger.fail('a.jpg', 'h', 'bad spec') == 'failed'
+
+def test_fails_an_unknown_job(ledger):
+    assert ledger.fail('a.jpg', 'h', 'boom', retry = True) == 'failed'
+    assert ledger.state('a.jpg', 'h') == 'failed'
+
+def test_fail_queued(ledger):
+    ledger.enqueue('a.jpg', 'h')
+    ledger.fail_queued('a.jpg', 'unreadable')
+    assert ledger.state('a.jpg', 'h') == 'failed'
+
+def test_new_contents_are_a_new_job(ledger):
+    ledger.enqueue('a.jpg', 'old')
+    # A queued (e.g. half written) version is replaced
+    ledger.enqueue('a.jpg', 'new')
+    assert ledger.state('a.jpg', 'old') is None
+    ledger.start('a.jpg', 'new')
+    ledger.finish('a.jpg', 'new')
+    assert ledger.enqueue('a.jpg', 'newer') == 'queued'
+    assert ledger.counts() == {'done' : 1, 'queued' : 1}
+    assert ledger.known('a.jpg') and not ledger.known('b.jpg')
+
+def test_recovers_crashed_jobs(ledger):
+    for name in ['a.jpg', 'b.jpg', 'c.jpg']:
+        ledger.enqueue(name, 'h')
+    ledger.start('a.jpg', 'h', worker = 'worker-0')
+    ledger.start('b.jpg', 'h', worker = 'worker-1')
+    assert ledger.recover('worker-0') == ['a.jpg']
+    assert ledger.state('b.jpg', 'h') == 'running'
+    assert ledger.recover() == ['b.jpg']
+
+def test_gives_up_on_jobs_that_keep_crashing(ledger):
+    ledger.enqueue('a.jpg', 'h')
+    for _ in range(2):
+        ledger.start('a.jpg', 'h')
+        ledger.recover()
+    assert ledger.state('a.jpg', 'h') == 'failed'
+    assert ledger.job('a.jpg', 'h')['error'] == 'interrupted'
+
+def test_hash_includes_the_sidecar(tmp_path):
+    photo = tmp_path / 'a.jpg'
+    spec  = tmp_path / 'a.jpg.spec.json'
+    photo.write_bytes(b'photo')
+    alone = hash_file(str(photo), str(spec))
+    assert alone == hash_file(str(photo))
+    spec.write_text('{"type" : "dream"}')
+    assert hash_file(str(photo), str(spec)) != alone
@@ -0,0 +1,88 @@
+import json
+import queue
+import threading
+import time
+
+import pytest
+
+import remote_watcher
+from job_ledger import JobLedger
+from app_utilities import spec_file_name
+
+@pytest.fixture
+def base_dir(tmp_path, monkeypatch):
+    # A private base image directory and ledger, with retries that don't wait
+    monkeypatch.setattr(remote_watcher, 'dream_base_dir', f'{tmp_path}/')
+    monkeypatch.setattr(remote_watcher, 'ledger', JobLedger(str(tmp_path / 'jobs.sqlite')))
+    monkeypatch.setattr(remote_watcher, 'retry_delay', 0.01)
+    monkeypatch.setattr(remote_watcher, 'prepare_errors', {})
+    return tmp_path
+
+def upload(base_dir, file_name, data):
+    (base_dir / file_name).write_bytes(data)
+    spec = {'type' : 'dream', 'strength' : True, 'artist' : 'Pablo Picasso'}
+    (base_dir / spec_file_name(file_name)).write_text(json.dumps(spec))
+
+def wait_for(condition, timeout = 30):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.05)
+
+def test_pipeline_survives_a_corrupt_upload(base_dir):
+    upload(base_dir, 'corrupt.jpg', b'not a jpeg')
+    file_hash = remote_watcher.hash_file(str(base_dir / 'corrupt.jpg'),
+                                         str(base_dir / spec_file_name('corrupt.jpg')))
+    jobs     = queue.Queue()
+    pipeline = remote_watcher.DreamPipeline(jobs, decode_workers = 1)
+    dreamer  = threading.Thread(target = pipeline.run, daemon = True)
+    dreamer.start()
+    jobs.put('corrupt.jpg')
+
+    ledger = remote_watcher.ledger
+    wait_for(lambda : ledger.state('corrupt.jpg', file_hash) == 'failed')
+    assert ledger.job('corrupt.jpg', file_hash)['attempts'] == ledger.max_attempts
+    # Still dreaming, and stops when asked
+    time.sleep(0.2)
+    assert dreamer.is_alive()
+    jobs.put(None)
+    dreamer.join(30)
+    assert not dreamer.is_alive()
+
+def test_process_dream_fails_a_corrupt_upload(base_dir):
+    upload(base_dir, 'corrupt.jpg', b'not a jpeg')
+    results = [remote_watcher.process_dream('corrupt.jpg') for _ in range(3)]
+    # Retried until the attempts run out, then done with
+    assert results == [False, False, True]
+    assert remote_watcher.ledger.counts() == {'failed' : 1}
+    assert remote_watcher.process_dream('corrupt.jpg') is True
+
+class Job:
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+def test_pipeline_decodes_one_job_ahead(monkeypatch):
+    dreaming = threading.Event()
+    release  = threading.Event()
+    def dream_job(job, on_preview):
+        dreaming.set()
+        release.wait(30)
+    monkeypatch.setattr(remote_watcher, 'try_prepare', Job)
+    monkeypatch.setattr(remote_watcher, 'dream_job', dream_job)
+    monkeypatch.setattr(remote_watcher, 'save_job', lambda job, image : None)
+
+    jobs = queue.Queue()
+    for index in range(5):
+        jobs.put(f'{index}.jpg')
+    pipeline = remote_watcher.DreamPipeline(jobs, decode_workers = 2, max_queued = 1)
+    dreamer  = threading.Thread(target = pipeline.run, daemon = True)
+    dreamer.start()
+    assert dreaming.wait(30)
+    time.sleep(0.2)
+    # One dreaming and one decoded; the rest are left for other workers
+    assert jobs.qsize() == 3
+
+    release.set()
+    jobs.put(None)
+    dreamer.join(30)
+    assert not dreamer.is_alive()
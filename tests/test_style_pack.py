@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from style_pack import write_pack, PackedStyles, ALIGNMENT, triangle_size
+from style_store import StyleStore
+from utilities import upper_triangle, gram_distance
+
+def symmetric(size, seed):
+    values = np.random.default_rng(seed).normal(size = (size, size)).astype(np.float32)
+    return (values + values.T)[np.newaxis]
+
+@pytest.fixture
+def targets():
+    return {'A' : [symmetric(8, 0), symmetric(30, 1)], 'B' : [symmetric(8, 2), symmetric(30, 3)]}
+
+def test_round_trip(tmp_path, targets):
+    path   = write_pack(targets, str(tmp_path / 'styles.pack'))
+    packed = PackedStyles(path)
+    assert sorted(packed.artists()) == ['A', 'B']
+    for artist, grams in targets.items():
+        for gram, triangle in zip(grams, packed.triangles(artist)):
+            rows, cols = np.triu_indices(gram.shape[-1])
+            np.testing.assert_array_equal(triangle, gram[0][rows, cols])
+            assert triangle.dtype == np.float32
+            assert (triangle.ctypes.data - packed.data.ctypes.data) % ALIGNMENT == 0
+            assert triangle_size(len(triangle)) == gram.shape[-1]
+
+def test_triangles_pack_as_they_are(tmp_path, targets):
+    # extract_styles writes triangles; they must pack the same as matrices
+    triangles = {artist : [upper_triangle(gram).numpy()[0] for gram in grams]
+                 for artist, grams in targets.items()}
+    first  = PackedStyles(write_pack(targets, str(tmp_path / 'grams.pack')))
+    second = PackedStyles(write_pack(triangles, str(tmp_path / 'triangles.pack')))
+    for a, b in zip(first.triangles('B'), second.triangles('B')):
+        np.testing.assert_array_equal(a, b)
+
+def test_rejects_float16_packs(tmp_path, targets):
+    path   = write_pack(targets, str(tmp_path / 'styles.pack'))
+    data   = bytearray(open(path, 'rb').read())
+    size   = int(np.frombuffer(data[:8], np.uint64)[0])
+    header = json.loads(data[8:8 + size])
+    header['dtype'] = 'float16'
+    # Same length, so the data stays where it was
+    data[8:8 + size] = json.dumps(header).encode().ljust(size)
+    open(path, 'wb').write(bytes(data))
+    with pytest.raises(ValueError):
+        PackedStyles(path)
+
+def test_store_serves_the_mapped_pages(tmp_path, targets):
+    path   = write_pack(targets, str(tmp_path / 'styles.pack'))
+    store  = StyleStore(pack_path = path)
+    inputs = store.get('A')
+    assert [tuple(tensor.shape) for tensor in inputs[1:]] == [(1, 36), (1, 465)]
+    assert store.get('A') is inputs and store.stats()['bytes'] == 0
+
+    # A change to the file shows in the tensor: it was not copied
+    packed = PackedStyles(path)
+    offset = packed.start + packed.index['A'][0]['offset']
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(np.float32(12345).tobytes())
+    assert float(inputs[1][0, 0]) == 12345
+
+def test_gram_distance_matches_the_full_matrices(targets):
+    target = targets['A'][1]
+    gram   = tf.constant(symmetric(30, 4))
+    full   = tf.reduce_mean(tf.square(target - gram), axis = [1, 2])
+    np.testing.assert_allclose(gram_distance(upper_triangle(target), gram), full, rtol = 1e-5)
@@ -0,0 +1,24 @@
+from traced_dreams import resolution_buckets, nearest_bucket
+
+buckets = resolution_buckets(resolutions = (384, 640, 896))
+
+def test_buckets_are_multiples_of_32():
+    assert all(side % 32 == 0 for bucket in buckets for side in bucket)
+    assert len(set(buckets)) == len(buckets) == 15
+
+def test_keeps_the_photos_aspect_ratio():
+    # Phone photos in both orientations, 16:9 and 4:3, and a square
+    assert nearest_bucket((1080, 1920), buckets) == (512, 896)
+    assert nearest_bucket((1920, 1080), buckets) == (896, 512)
+    assert nearest_bucket((3024, 4032), buckets) == (672, 896)
+    assert nearest_bucket((4032, 3024), buckets) == (896, 672)
+    assert nearest_bucket((5000, 5000), buckets) == (896, 896)
+
+def test_never_enlarges_the_photo():
+    assert nearest_bucket((600, 800), buckets) == (480, 640)
+    assert nearest_bucket((480, 640), buckets) == (480, 640)
+    assert nearest_bucket((700, 700), buckets) == (640, 640)
+
+def test_smaller_than_every_bucket_gets_the_smallest():
+    assert nearest_bucket((200, 150), buckets) == (384, 288)
+    assert nearest_bucket((100, 100), buckets) == (384, 384)
@@ -174,7 +174,14 @@ def main():
 
             # Periodically poll for completion and update progress bar
             apology_message_printed = False
+            preview_shown           = False
             while not dream_done:
+                # Show the server's early preview as soon as it arrives
+                if not preview_shown and check_for_preview(file_name):
+                    preview   = lit_load_image(dreamt_dir + preview_file_name(file_name))
+                    im_disp_a.image([base_image, preview], width = 300, use_column_width = False)
+                    preview_shown = True
+
                 # Compute time taken
                 time_elapsed = (datetime.now() - start_time).seconds
                 pct_elapsed  = time_elapsed/expected_wait
@@ -201,7 +208,7 @@ def main():
                         st.balloons()
                         session.wait_times.append(time_elapsed)
                         dream_image = load_dream_image(file_name)
-                        im_disp     = st.image([base_image, dream_image], width = 300, use_column_width = False)
+                        im_disp_a.image([base_image, dream_image], width = 300, use_column_width = False)
                         next_dream_button()
                         break
 
@@ -248,6 +255,12 @@ def dreamt_file_name(file_name):
 def check_for_dream(file_name):
     return os.path.exists(dreamt_dir+dreamt_file_name(file_name))
 
+def preview_file_name(file_name):
+    return 'preview-' + dreamt_file_name(file_name)[len('dreamt-'):]
+
+def check_for_preview(file_name):
+    return os.path.exists(dreamt_dir+preview_file_name(file_name))
+
 @st.cache
 def load_dream_image(file_name):
     file_name = dreamt_file_name(file_name)
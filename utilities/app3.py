@@ -27,7 +27,10 @@ from app_utilities import (
     check_for_dream,
     get_dream_time,
     get_dream_pairs,
-    update_config
+    save_dream_spec,
+    local_spec_path,
+    post_style_image,
+    auto_artist
 )
 
 ################################################################################
@@ -36,7 +39,8 @@ from app_utilities import (
 #
 ################################################################################
 
-session = SessionState.get(config_state = ('dream', True, 'Pablo Picasso'), seen_before = [])
+session = SessionState.get(config_state = ('dream', True, 'Pablo Picasso'), seen_before = [],
+                           posted_styles = {})
 
 
 ################################################################################
@@ -60,19 +64,25 @@ def main():
         strength = (strength == 'Dark Roast')
 
         artist_names = [artist.strip() for artist in class_names]
-        artist   = st.selectbox('Artist', artist_names)
+        # The first artist stays the default; picking the closest one is opt-in
+        artist   = st.selectbox('Artist', artist_names + ['Auto: closest to your photo', 'Your own style image'])
         if artist == 'Wassily Kandinsky':
             artist = ' ' + artist
+        elif artist == 'Auto: closest to your photo':
+            artist = auto_artist
+        elif artist == 'Your own style image':
+            artist = upload_style_image()
     else:
         strength = True
         artist   = 'Pablo Picasso'
 
     curr_config_state = (style, strength, artist)
     print(f'Config: {curr_config_state}')
-    if curr_config_state != session.config_state:
+    if curr_config_state != session.config_state or not os.path.exists(local_spec_path):
         print('Updating Config')
         session.config_state = curr_config_state
-        update_config(*curr_config_state)
+        # Posted with each photo from now on, as its spec
+        save_dream_spec(*curr_config_state)
 
     wait_for_dream = st.button('Look for a Dream')
     empty_spot     = st.empty()
@@ -151,6 +161,17 @@ def load_dream_image(file_name):
     file_name = dreamt_file_name(file_name)
     return lit_load_image(dreamt_dir+file_name)
 
+# Post an uploaded style image once; keeps the previous config until one is given
+def upload_style_image():
+    upload = st.file_uploader('Style image', type = ['jpg', 'png'])
+    if upload is None:
+        return session.config_state[2]
+    data = upload.getvalue()
+    if data not in session.posted_styles:
+        file_type = 'png' if upload.name.lower().endswith('png') else 'jpg'
+        session.posted_styles[data] = post_style_image(data, file_type)
+    return session.posted_styles[data] or session.config_state[2]
+
 def half_list(list_):
     num = len(list_) // 2
     return list_[:-num]
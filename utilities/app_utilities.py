@@ -1,6 +1,9 @@
 from utilities import class_names
 
 import glob
+import hashlib
+import json
+import shutil
 import os
 
 # Streamlit tends to run files from unknown locations so I have hardcoded these
@@ -8,7 +11,19 @@ dream_base_dir         = '/Users/rcharan/Downloads/'
 dreamt_dir             = '/Users/rcharan/Dropbox/Flatiron/final-project/art-dream/dreamt-images/'
 remote_dreamt_dir      = '~/art-dream/dreamt-images/'
 remote_dream_base_dir  = '~/art-dream/dream-base-images/'
+remote_style_dir       = '~/art-dream/style-images/'
+local_style_dir        = '/Users/rcharan/Dropbox/Flatiron/final-project/art-dream/style-images/'
+# Must match in lit_app/user_styles.py and lit_app/closest_artist.py
+user_style_prefix      = 'style-image:'
+auto_artist            = 'auto'
 dream_file_type = 'jpg'
+# The dream spec the app has selected, and each photo's copy of it, taken
+#  when the photo arrives
+local_spec_path        = '/Users/rcharan/Dropbox/Flatiron/final-project/art-dream/dream-spec.json'
+local_spec_dir         = '/Users/rcharan/Dropbox/Flatiron/final-project/art-dream/dream-specs/'
+# A photo's spec travels next to it, as <photo name> + spec_suffix
+spec_suffix            = '.spec.json'
+dream_types            = ['dream', 'dream-style']
 
 # Alias I am so so sorry
 local_dreamt_dir       = dreamt_dir
@@ -36,6 +51,13 @@ def dreamt_file_name(file_name):
 def check_for_dream(file_name, dreamt_dir = dreamt_dir):
     return os.path.exists(dreamt_dir+dreamt_file_name(file_name))
 
+# Early (coarse) dreams published by the server while the dream finishes
+def preview_file_name(file_name):
+    return 'preview-' + dreamt_file_name(file_name)[len('dreamt-'):]
+
+def check_for_preview(file_name, dreamt_dir = dreamt_dir):
+    return os.path.exists(dreamt_dir+preview_file_name(file_name))
+
 def get_dream_time(file_name_pair):
     dream_path = dreamt_dir + file_name_pair[1]
     return os.path.getctime(dream_path)
@@ -73,20 +95,26 @@ def _remote_fetch_command(file_name):
     scp_command = f'gcloud compute scp jupyter@flatiron:'
     return scp_command + f'"{remote_dreamt_dir}{file_name}"' + f' {local_dreamt_dir}' + ' --compress'
 
-# Command to put a file onto the remote file system
-def _remote_put_command(file_path):
-    scp_command = f'gcloud compute scp "{file_path}"'
+# Command to put files onto the remote file system (in one connection, in order)
+def _remote_put_command(*file_paths):
+    scp_command = 'gcloud compute scp ' + ' '.join(f'"{file_path}"' for file_path in file_paths)
     return scp_command + f' jupyter@flatiron:{remote_dream_base_dir}' + ' --compress'
 
 
 
 # Functions to post and fetch files
 def post_file(file_path, bare_name):
-    return_code = os.system(_remote_put_command(file_path))
+    # With the photo's spec, in the same scp and first, so the spec is
+    #  there when the dreamer sees the photo
+    spec_path   = snapshot_dream_spec(file_path.split('/')[-1])
+    file_paths  = ([spec_path] if spec_path is not None else []) + [file_path]
+    return_code = os.system(_remote_put_command(*file_paths))
     if return_code != 0:
         print(f'{bare_name} -- WARNING: failed to post with return code {return_code}')
         return False
     else:
+        if spec_path is not None:
+            os.remove(spec_path)
         print(f'{bare_name} -- Posted')
         return True
 
@@ -97,17 +125,88 @@ def fetch_file(file_name):
     else:
         return True
 
-def update_config(model_type, strong=True, artist_name='Pablo Picasso'):
-    assert type(strong) == bool
-    assert model_type in ['dream', 'dream-style']
-    assert artist_name in class_names.tolist()
-
-    strong = 'true' if strong else 'false'
-    config_str = ', '.join([model_type, strong, artist_name])
+def spec_file_name(file_name):
+    return file_name + spec_suffix
+
+def check_dream_spec(spec):
+    '''
+        A validated copy of a dream spec: a dict of type, strength, artist
+        and (optional) budget, the wall-clock seconds the dream may take.
+        Raises ValueError
+    '''
+    if not isinstance(spec, dict):
+        raise ValueError(f'spec must be an object, not {type(spec).__name__}')
+    unknown = set(spec) - {'type', 'strength', 'artist', 'budget'}
+    if unknown:
+        raise ValueError(f'unknown spec fields {sorted(unknown)}')
+
+    model_type = spec.get('type')
+    if model_type not in dream_types:
+        raise ValueError(f'type must be one of {dream_types}, not {model_type!r}')
+    strong = spec.get('strength', True)
+    if not isinstance(strong, bool):
+        raise ValueError(f'strength must be true or false, not {strong!r}')
+
+    # Artists match with or without their padding (' Wassily Kandinsky')
+    artist_name = spec.get('artist', 'Pablo Picasso')
+    artists     = {str(name).strip() : str(name) for name in class_names}
+    if not isinstance(artist_name, str):
+        raise ValueError(f'artist must be a string, not {artist_name!r}')
+    elif artist_name.strip() in artists:
+        artist_name = artists[artist_name.strip()]
+    elif artist_name != auto_artist and not artist_name.startswith(user_style_prefix):
+        raise ValueError(f'unknown artist {artist_name!r}')
+    elif artist_name.startswith(user_style_prefix) and '/' in artist_name:
+        raise ValueError(f'style image names cannot contain a path ({artist_name!r})')
+
+    budget = spec.get('budget')
+    if budget is not None and (isinstance(budget, bool) or not isinstance(budget, (int, float))
+                               or budget <= 0):
+        raise ValueError(f'budget must be a positive number of seconds, not {budget!r}')
+
+    return {'type' : model_type, 'strength' : strong, 'artist' : artist_name, 'budget' : budget}
+
+# Select the spec for photos posted from now on (replaces setting the
+#  server's dreamer_config.txt over ssh)
+def save_dream_spec(model_type, strong = True, artist_name = 'Pablo Picasso', budget = None,
+                    path = local_spec_path):
+    spec = check_dream_spec({'type' : model_type, 'strength' : strong,
+                             'artist' : artist_name, 'budget' : budget})
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(spec, f)
+    os.replace(tmp_path, path)
+    return spec
+
+# Copy the selected spec as the sidecar of the photo file_name, as soon as
+#  the photo arrives, so a later change of selection does not affect it.
+#  An existing copy is kept (a converted HEIC's was taken on its arrival).
+#  Returns the copy's path, or None if no spec has been selected (the server
+#  then falls back on its dreamer_config.txt)
+def snapshot_dream_spec(file_name, path = local_spec_path):
+    spec_path = local_spec_dir + spec_file_name(file_name)
+    if os.path.exists(spec_path):
+        return spec_path
+    if not os.path.exists(path):
+        print(f'{file_name} -- no dream spec selected, the server will use its default')
+        return None
+    os.makedirs(local_spec_dir, exist_ok = True)
+    shutil.copyfile(path, spec_path)
+    return spec_path
+
+# Save an uploaded style image under the hash of its contents (so repeats
+#  share the server's cache) and post it. Returns the name to use as the
+#  artist in the config, or None if posting failed
+def post_style_image(data, file_type = 'jpg'):
+    file_name = hashlib.sha256(data).hexdigest()[:32] + '.' + file_type
+    file_path = local_style_dir + file_name
+    os.makedirs(local_style_dir, exist_ok = True)
+    with open(file_path, 'wb') as f:
+        f.write(data)
 
-    ssh_command     = 'gcloud compute ssh jupyter@flatiron'
-    echo_command    = f''' --command 'echo "{config_str}" '''
-    cat_command     = f" > ~/art-dream/lit_app/dreamer_config.txt'"
-
-    command = ssh_command + echo_command + cat_command
-    os.system(command)
+    scp_command = f'gcloud compute scp "{file_path}"'
+    return_code = os.system(scp_command + f' jupyter@flatiron:{remote_style_dir}' + ' --compress')
+    if return_code != 0:
+        print(f'{file_name} -- WARNING: failed to post style image with return code {return_code}')
+        return None
+    return user_style_prefix + file_name
@@ -0,0 +1,222 @@
+import tensorflow as tf
+from xla import XlaSwitch, benchmark
+
+class CompiledStep:
+    '''
+        A long-lived, compiled optimisation loop for a Keras dream model
+
+        Stands in for model.compile + model.fit: the optimizer is built once
+        and the loop is traced once, so each job only pays for its gradient
+        steps. Between jobs the image is loaded into the model and the
+        optimizer's slots are zeroed in place.
+
+        The loss is the model output summed over the batch: for a batch of
+        one that is what model.fit minimised with precomputed_loss, and for
+        a batch of images each one gets the gradient it would get alone.
+    '''
+    def __init__(self, model, learning_rate, layer_name = 'image', jit_compile = False):
+        self.model     = model
+        self.image     = model.get_layer(layer_name).kernel
+        self.optimizer = tf.optimizers.Adam(learning_rate = learning_rate)
+        self.run       = XlaSwitch(self._run, enabled = jit_compile)
+        self.loss      = tf.function(self._loss)
+
+        # Image before the latest step, and the best image seen (early stopping)
+        self.previous  = tf.Variable(tf.zeros_like(self.image), trainable = False)
+        self.best      = tf.Variable(tf.zeros_like(self.image), trainable = False)
+
+    def step(self, inputs):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(self.model(inputs))
+        gradients = tape.gradient(loss, [self.image])
+        # The optimizer applies the image's kernel_constraint, as fit did
+        self.optimizer.apply_gradients(zip(gradients, [self.image]))
+        return loss
+
+    def _loss(self, inputs):
+        return tf.reduce_sum(self.model(inputs))
+
+    def _run(self, inputs, steps):
+        loss = tf.constant(0.0)
+        for n in tf.range(steps):
+            loss = self.step(inputs)
+        return loss
+
+    def reset(self, image):
+        self.image.assign(image)
+        for variable in self.optimizer.variables():
+            variable.assign(tf.zeros_like(variable))
+
+    def start(self, image, inputs, steps):
+        if not self.run.is_calibrated(inputs, steps):
+            # Calibrating runs the loop; the reset below undoes it
+            self.run.calibrate(inputs, steps)
+        self.reset(image)
+
+    def __call__(self, image, steps, inputs):
+        steps = tf.constant(steps)
+        self.start(image, inputs, steps)
+        return self.run(inputs, steps)
+
+    def run_until(self, image, inputs, criterion, max_steps):
+        '''
+            As __call__, but one step at a time, stopping early when the
+            StopCriterion says so. The best image seen is left in the model
+        '''
+        one = tf.constant(1)
+        self.start(image, inputs, one)
+        criterion.start()
+        steps_taken = 0
+        for step in range(max_steps):
+            # Each step reports the loss of the image it started from
+            self.previous.assign(self.image)
+            loss = float(self.run(inputs, one))
+            steps_taken += 1
+            if criterion.update(loss, step):
+                self.best.assign(self.previous)
+            if criterion.should_stop():
+                break
+
+        # The last step's image has not been scored yet
+        if criterion.update(float(self.loss(inputs)), steps_taken):
+            self.best.assign(self.image)
+        self.image.assign(self.best)
+        return criterion.best_loss
+
+    def benchmark_xla(self, inputs, steps = 5):
+        label = 'x'.join(str(size) for size in self.image.shape[1:3])
+        return benchmark(self._run, {label : (inputs, tf.constant(steps))}, steps)
+
+# L-BFGS (s, y) history buffers by (history, size); see LbfgsStep
+_lbfgs_histories = {}
+
+def lbfgs_history(history, size):
+    key = (history, size)
+    if key not in _lbfgs_histories:
+        _lbfgs_histories[key] = (tf.Variable(tf.zeros([history, size]), trainable = False),
+                                 tf.Variable(tf.zeros([history, size]), trainable = False))
+    return _lbfgs_histories[key]
+
+class LbfgsStep(CompiledStep):
+    '''
+        CompiledStep with L-BFGS in place of Adam
+
+        Each step is one loss and gradient evaluation: the direction comes
+        from the two-loop recursion over the last `history` (s, y) pairs and
+        is taken without a line search, but shrunk so that no pixel moves
+        more than max_step. The first step (with no history) moves the
+        largest gradient by learning_rate. The kernel_constraint is applied
+        after every step.
+
+        The (s, y) history takes 2 * history * pixels * 3 float32s: 192MB
+        for an 896x896 image at history 10. It is allocated on first use,
+        and shared by every step on an image of the same size, since a
+        process dreams one job at a time and each job starts a new history.
+    '''
+    def __init__(self, model, learning_rate, layer_name = 'image', jit_compile = False,
+                 history = 10, max_step = None):
+        super().__init__(model, learning_rate, layer_name, jit_compile)
+        self.learning_rate = learning_rate
+        self.max_step      = max_step if max_step is not None else 5 * learning_rate
+        self.history       = history
+        self.constraint    = getattr(self.image, 'constraint', None)
+
+        size = tf.size(self.image)
+        self.s          = None
+        self.y          = None
+        self.rho        = tf.Variable(tf.zeros([history]), trainable = False)
+        self.head       = tf.Variable(0, trainable = False)
+        self.count      = tf.Variable(0, trainable = False)
+        self.iterations = tf.Variable(0, trainable = False)
+        self.last_x     = tf.Variable(tf.zeros([size]), trainable = False)
+        self.last_g     = tf.Variable(tf.zeros([size]), trainable = False)
+
+    def allocate(self):
+        if self.s is None:
+            self.s, self.y = lbfgs_history(self.history, int(tf.size(self.image)))
+
+    def start(self, image, inputs, steps):
+        self.allocate()
+        super().start(image, inputs, steps)
+
+    def benchmark_xla(self, inputs, steps = 5):
+        self.allocate()
+        return super().benchmark_xla(inputs, steps)
+
+    def remember(self, x, gradient):
+        # Store the latest (s, y) pair, unless it breaks positive curvature
+        s  = x - self.last_x
+        y  = gradient - self.last_g
+        sy = tf.tensordot(s, y, 1)
+        if sy > 1e-10:
+            self.s[self.head].assign(s)
+            self.y[self.head].assign(y)
+            self.rho[self.head].assign(1.0 / sy)
+            self.head.assign((self.head + 1) % self.history)
+            self.count.assign(tf.minimum(self.count + 1, self.history))
+
+    def direction(self, gradient):
+        # Two-loop recursion: newest pair first, then back from the oldest
+        q      = gradient
+        alphas = []
+        for i in range(self.history):
+            index = (self.head - 1 - i) % self.history
+            valid = tf.cast(i < self.count, tf.float32)
+            alpha = valid * self.rho[index] * tf.tensordot(self.s[index], q, 1)
+            q     = q - alpha * self.y[index]
+            alphas.append(alpha)
+
+        newest = (self.head - 1) % self.history
+        gamma  = 1.0 / (self.rho[newest] * tf.tensordot(self.y[newest], self.y[newest], 1))
+        r      = gamma * q
+        for i in reversed(range(self.history)):
+            index = (self.head - 1 - i) % self.history
+            valid = tf.cast(i < self.count, tf.float32)
+            beta  = self.rho[index] * tf.tensordot(self.y[index], r, 1)
+            r     = r + valid * (alphas[i] - beta) * self.s[index]
+        return -r
+
+    def step(self, inputs):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(self.model(inputs))
+        gradient = tf.reshape(tape.gradient(loss, self.image), [-1])
+        x        = tf.reshape(self.image, [-1])
+
+        if self.iterations > 0:
+            self.remember(x, gradient)
+        if self.count > 0:
+            direction = self.direction(gradient)
+        else:
+            direction = -gradient * self.learning_rate / tf.reduce_max(tf.abs(gradient))
+        direction = direction * tf.minimum(1.0, self.max_step / tf.reduce_max(tf.abs(direction)))
+
+        self.last_x.assign(x)
+        self.last_g.assign(gradient)
+        self.iterations.assign_add(1)
+        image = self.image + tf.reshape(direction, tf.shape(self.image))
+        if self.constraint is not None:
+            image = self.constraint(image)
+        self.image.assign(image)
+        return loss
+
+    def reset(self, image):
+        self.image.assign(image)
+        for variable in [self.head, self.count, self.iterations]:
+            variable.assign(0)
+
+# Optimisers the compiled step can use
+optimizers = {'adam' : CompiledStep, 'lbfgs' : LbfgsStep}
+
+# One compiled step per (model, learning rate, optimiser), kept for the life of the process
+_compiled_steps = {}
+
+def get_compiled_step(model, learning_rate, jit_compile = False, optimizer = 'adam'):
+    key = (id(model), learning_rate, optimizer)
+    if key not in _compiled_steps:
+        _compiled_steps[key] = optimizers[optimizer](model, learning_rate, jit_compile = jit_compile)
+    return _compiled_steps[key]
+
+def release_compiled_steps(model):
+    # Drop a discarded model's compiled steps (the key is its id, which may be reused)
+    for key in [key for key in _compiled_steps if key[0] == id(model)]:
+        del _compiled_steps[key]
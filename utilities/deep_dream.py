@@ -1,13 +1,73 @@
 import tensorflow as tf
+from collections  import deque
 from progress_bar import ProgressBar
+from images       import vgg19_deprocess_image
+from xla          import XlaSwitch, benchmark
+
+# Batched dreams are padded up to a multiple of this many pixels so that
+#  photos of similar (not identical) sizes can share a bucket and a graph call
+BUCKET_MULTIPLE = 64
+
+def normalize_gradients(gradients, mask):
+    # Normalize each image in the batch separately (ignoring padding) so that
+    #  one image's gradients never rescale another's
+    axes      = [1, 2, 3]
+    count     = tf.reduce_sum(mask, axis = axes, keepdims = True) * 3
+    mean      = tf.reduce_sum(gradients * mask, axis = axes, keepdims = True) / count
+    variance  = tf.reduce_sum(tf.square((gradients - mean) * mask), axis = axes, keepdims = True) / count
+    gradients = gradients / (tf.sqrt(variance) + 1e-8)
+
+    # Padding never changes
+    return gradients * mask
+
+def bucket_shape(shape, multiple = BUCKET_MULTIPLE):
+    height, width = shape
+    height = -(-height // multiple) * multiple
+    width  = -(-width  // multiple) * multiple
+    return height, width
+
+def pad_to_bucket(img, bucket):
+    # Reflect the image into the padding so the network sees natural borders
+    #  and build a mask marking the real pixels. A reflection adds at most
+    #  the image's own size, so small images are reflected again (tiled)
+    height, width = img.shape[:2]
+    padded = img
+    while padded.shape[0] < bucket[0] or padded.shape[1] < bucket[1]:
+        padded = tf.pad(padded, [[0, min(bucket[0] - padded.shape[0], padded.shape[0])],
+                                 [0, min(bucket[1] - padded.shape[1], padded.shape[1])], [0, 0]],
+                        mode = 'SYMMETRIC')
+    paddings = [[0, bucket[0] - height], [0, bucket[1] - width], [0, 0]]
+    mask     = tf.pad(tf.ones([height, width, 1]), paddings)
+    return padded, mask
+
+def snapshot(img, preview_size = None, quantize = False):
+    # Copy a dream (batch of one) off the device, optionally shrunk so its
+    #  longest side is at most preview_size and deprocessed to uint8
+    if preview_size is None and not quantize:
+        return img.numpy()
+
+    img = img[0]
+    if preview_size is not None:
+        height, width = img.shape[:2]
+        scale = preview_size / max(height, width)
+        if scale < 1:
+            img = tf.image.resize(img, [int(height * scale), int(width * scale)])
+    if quantize:
+        return vgg19_deprocess_image(img).numpy()
+    return img.numpy()[None]
 
 class DeepDream(tf.Module):
 
-    def __init__(self, model, artist_vector):
+    def __init__(self, model, artist_vector, jit_compile = False):
         self.model         = model
         self.artist_vector = tf.convert_to_tensor(artist_vector)
         self.artist_vector = tf.cast(self.artist_vector, tf.float32)
 
+        # Opt-in XLA for the dream loop, kept per resolution only if faster
+        self.jit_compile   = jit_compile
+        if jit_compile:
+            self.xla_switch = XlaSwitch(self.gradient_ascent)
+
     @tf.function(
         input_signature=(
             tf.TensorSpec(shape=[None,None,None,3], dtype=tf.float32),
@@ -15,6 +75,11 @@ class DeepDream(tf.Module):
             tf.TensorSpec(shape=[], dtype=tf.float32),
     ))
     def __call__(self, img, steps, learning_rate):
+        return self.gradient_ascent(img, steps, learning_rate)
+
+    def gradient_ascent(self, img, steps, learning_rate):
+        # Untraced dream loop; traced by __call__ for any shape, or per shape
+        #  by the XLA switch
         loss = tf.constant(0.0)
         for n in tf.range(steps):
             with tf.GradientTape() as tape:
@@ -34,27 +99,228 @@ class DeepDream(tf.Module):
 
         return img
 
+    def dream(self, img, steps, learning_rate):
+        # __call__, or its XLA version where that measured faster
+        if not self.jit_compile:
+            return self(img, steps, learning_rate)
+        if not self.xla_switch.is_calibrated(img, steps, learning_rate):
+            self.xla_switch.calibrate(img, steps, learning_rate)
+        return self.xla_switch(img, steps, learning_rate)
+
+    @tf.function(
+        input_signature=(
+            tf.TensorSpec(shape=[None,None,None,3], dtype=tf.float32),
+    ))
+    def loss(self, img):
+        return tf.reduce_sum(tf.math.square(self.model(img)))
+
+    def run_deep_dream_until(self,
+                             img,
+                             criterion,
+                             max_steps = 100,
+                             learning_rate = 1.0,
+                             check_every = 5):
+        '''
+            Dream until max_steps or until the StopCriterion stops it,
+            checking the loss every check_every steps. Returns the best
+            dream seen. This is gradient ascent, so the criterion must be
+            built with mode = 'max'
+        '''
+        # Not set here: the criterion is the caller's (who reads its results)
+        assert criterion.mode == 'max'
+        criterion.start()
+        best = img
+        criterion.update(float(self.loss(img)), 0)
+
+        steps_done = 0
+        while steps_done < max_steps and not criterion.should_stop():
+            run_steps   = min(check_every, max_steps - steps_done)
+            img         = self.dream(img, tf.constant(run_steps), tf.constant(learning_rate))
+            steps_done += run_steps
+            if criterion.update(float(self.loss(img)), steps_done):
+                best = img
+
+        return best
+
+    def benchmark_xla(self, resolutions = (512, 768, 896), steps = 10):
+        args = {f'{size}x{size}' : (tf.random.uniform([1, size, size, 3], -100, 100),
+                                    tf.constant(steps),
+                                    tf.constant(1.0))
+                for size in resolutions}
+        return benchmark(self.gradient_ascent, args, steps)
+
+    @tf.function(
+        input_signature=(
+            tf.TensorSpec(shape=[None,None,None,3], dtype=tf.float32),
+            tf.TensorSpec(shape=[None,None,None,1], dtype=tf.float32),
+            tf.TensorSpec(shape=[], dtype=tf.int32),
+            tf.TensorSpec(shape=[], dtype=tf.float32),
+    ))
+    def dream_batch(self, imgs, mask, steps, learning_rate):
+        # As __call__, but for a padded batch of different images.
+        #  The summed loss separates per image, so each image only receives
+        #  gradients from its own activations
+        for n in tf.range(steps):
+            with tf.GradientTape() as tape:
+                tape.watch(imgs)
+                activations = self.model(imgs)
+                loss        = tf.reduce_sum(tf.math.square(activations))
+
+            gradients = tape.gradient(loss, imgs)
+            gradients = normalize_gradients(gradients, mask)
+            imgs      = imgs + gradients * learning_rate
+
+        return imgs
+
+    @tf.function(
+        input_signature=(
+            tf.TensorSpec(shape=[None,None,None,3], dtype=tf.float32),
+            tf.TensorSpec(shape=[None], dtype=tf.int32),
+            tf.TensorSpec(shape=[], dtype=tf.int32),
+            tf.TensorSpec(shape=[], dtype=tf.float32),
+    ))
+    def dream_artists(self, imgs, artist_indices, steps, learning_rate):
+        # Targeted dreams: image k ascends the activation of artist k only
+        mask = tf.ones_like(imgs[..., :1])
+        for n in tf.range(steps):
+            with tf.GradientTape() as tape:
+                tape.watch(imgs)
+                activations = self.model(imgs)
+                targets     = tf.one_hot(artist_indices, tf.shape(activations)[-1])
+                loss        = tf.reduce_sum(activations * targets)
+
+            gradients = tape.gradient(loss, imgs)
+            gradients = normalize_gradients(gradients, mask)
+            imgs      = imgs + gradients * learning_rate
+
+        return imgs
+
+    def run_artist_fan_out(self,
+                           img,
+                           artist_indices,
+                           steps = 100,
+                           learning_rate = 1.0):
+        '''
+            Dream one (pre-processed) image towards several artists at once
+
+            artist_indices index into utilities.class_names. The image is
+            copied once per artist and all copies are optimised together in
+            one batched graph call. Returns one dream (batch of one) per artist
+        '''
+        img  = tf.reshape(img, tf.shape(img)[-3:])
+        imgs = tf.stack([img] * len(artist_indices))
+        imgs = self.dream_artists(imgs,
+                                  tf.constant(artist_indices, dtype = tf.int32),
+                                  tf.constant(steps),
+                                  tf.constant(learning_rate))
+        return [tf.expand_dims(dream, axis = 0) for dream in tf.unstack(imgs)]
+
+    def run_deep_dream_batch(self,
+                             imgs,
+                             steps = 100,
+                             learning_rate = 1.0,
+                             bucket_multiple = BUCKET_MULTIPLE):
+        '''
+            Dream on several (pre-processed) images at once
+
+            Images may be of different sizes (with or without a batch
+            dimension of one). They are grouped into buckets by padded size
+            and each bucket is dreamt in a single graph call. Returns the
+            dreams in the order given, each in a batch of one.
+        '''
+        imgs    = [tf.reshape(img, tf.shape(img)[-3:]) for img in imgs]
+        buckets = {}
+        for index, img in enumerate(imgs):
+            bucket = bucket_shape(img.shape[:2], bucket_multiple)
+            buckets.setdefault(bucket, []).append(index)
+
+        dreams = [None] * len(imgs)
+        for bucket, indices in buckets.items():
+            padded, masks = zip(*[pad_to_bucket(imgs[i], bucket) for i in indices])
+            batch = self.dream_batch(tf.stack(padded),
+                                     tf.stack(masks),
+                                     tf.constant(steps),
+                                     tf.constant(learning_rate))
+            for i, dream in zip(indices, tf.unstack(batch)):
+                height, width = imgs[i].shape[:2]
+                dreams[i]     = tf.expand_dims(dream[:height, :width], axis = 0)
+
+        return dreams
+
+    def run_deep_dream_progressive(self,
+                                   img,
+                                   coarse_scale = 0.5,
+                                   coarse_steps = 50,
+                                   fine_steps = 25,
+                                   learning_rate = 1.0,
+                                   on_preview = None):
+        '''
+            Coarse-to-fine dream of a (pre-processed) batch of one
+
+            Dreams a copy shrunk by coarse_scale first and hands it to
+            on_preview as soon as it is ready. Only the change made by the
+            coarse dream is upsampled onto the full-size image (as in
+            DreamImage.decode_dream), and the fine pass starts from there,
+            so it needs fewer steps than dreaming from scratch
+        '''
+        full_shape   = tf.shape(img)[1:3]
+        coarse_shape = tf.cast(tf.cast(full_shape, tf.float32) * coarse_scale, tf.int32)
+
+        coarse       = tf.image.resize(img, coarse_shape)
+        coarse_dream = self.dream(coarse, tf.constant(coarse_steps), tf.constant(learning_rate))
+        if on_preview is not None:
+            on_preview(coarse_dream)
+
+        img = img + tf.image.resize(coarse_dream - coarse, full_shape)
+        return self.dream(img, tf.constant(fine_steps), tf.constant(learning_rate))
+
+    def stream_deep_dream(self,
+                          img,
+                          steps = 100,
+                          learning_rate = 1.0,
+                          update_frequency = 5,
+                          preview_size = None,
+                          quantize = False):
+        '''
+            Generator version of run_deep_dream_simple
+
+            Yields (steps_done, img, snapshot) every update_frequency steps
+            as the dream progresses. Only the snapshot is copied off the
+            device, downsampled and quantised as requested (see snapshot)
+        '''
+        steps_remaining = steps
+        steps_done      = 0
+        while steps_remaining:
+            run_steps        = min(steps_remaining, update_frequency)
+            steps_remaining -= run_steps
+            steps_done      += run_steps
+
+            img = self.dream(img, tf.constant(run_steps), tf.constant(learning_rate))
+            yield steps_done, img, snapshot(img, preview_size, quantize)
+
     def run_deep_dream_simple(self,
                               img,
                               steps = 100,
                               learning_rate = 1.0,
-                              update_frequency = 5):
-        updates = []
+                              update_frequency = 5,
+                              max_updates = None,
+                              preview_size = None,
+                              quantize = False,
+                              callback = None):
+        # Keep at most max_updates snapshots (the most recent); pass a
+        #  callback to consume them as they are made instead (then none
+        #  are kept, and the list returned is empty)
+        updates = deque(maxlen = max_updates)
         progress_bar = ProgressBar(steps)
         progress_bar.start()
 
-        steps_remaining = steps
-        steps_done      = 0
-        while steps_remaining:
-            if steps_remaining>update_frequency:
-                run_steps = tf.constant(update_frequency)
+        stream = self.stream_deep_dream(img, steps, learning_rate, update_frequency,
+                                        preview_size = preview_size, quantize = quantize)
+        for steps_done, img, update in stream:
+            if callback is not None:
+                callback(steps_done, update)
             else:
-                run_steps = tf.constant(steps_remaining)
-            steps_remaining -= run_steps
-            steps_done      += run_steps
-
-            img = self(img, run_steps, tf.constant(learning_rate))
-            updates.append(img.numpy())
+                updates.append(update)
             progress_bar.update(steps_done)
 
-        return img, updates
+        return img, list(updates)
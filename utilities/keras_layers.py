@@ -1,4 +1,5 @@
 import tensorflow as tf
+import numpy as np
 from tensorflow.keras.layers import Layer
 
 from images import vgg19_deprocess_image, inceptionV3_deprocess_image
@@ -9,7 +10,58 @@ def gram_matrix(activations):
     input_shape   = tf.shape(activations)
     num_locations = tf.cast(input_shape[1]*input_shape[2], tf.float32)
     return result/(num_locations)
- 
+
+def sampled_gram_matrix(num_samples = 16384, method = 'random'):
+    '''
+        An estimate of gram_matrix from num_samples spatial locations,
+        redrawn on every call, for large (early) layers
+
+        'random' gathers locations uniformly (with replacement); 'strided'
+        takes every n-th row and column from a random offset. Either way
+        the result is an unbiased estimate of the full Gram matrix. Layers
+        with no more than num_samples locations get the exact version
+    '''
+    assert method in ['random', 'strided']
+    def gram(activations):
+        if activations.shape[1] * activations.shape[2] <= num_samples:
+            return gram_matrix(activations)
+
+        input_shape   = tf.shape(activations)
+        num_locations = input_shape[1]*input_shape[2]
+        if method == 'strided':
+            ratio   = tf.cast(num_locations, tf.float32) / num_samples
+            stride  = tf.cast(tf.math.ceil(tf.sqrt(ratio)), tf.int32)
+            offset  = tf.random.uniform([2], 0, stride, dtype = tf.int32)
+            sampled = activations[:, offset[0]::stride, offset[1]::stride, :]
+            return gram_matrix(sampled)
+
+        flat    = tf.reshape(activations, [input_shape[0], num_locations, input_shape[3]])
+        indices = tf.random.uniform([num_samples], 0, num_locations, dtype = tf.int32)
+        sampled = tf.gather(flat, indices, axis = 1)
+        result  = tf.linalg.einsum('anb,anc->abc', sampled, sampled)
+        return result/num_samples
+    return gram
+
+# Gram matrices are symmetric, so style targets keep only their upper
+#  triangles, row by row (as np.triu_indices): (batch, n(n+1)/2)
+def upper_triangle(matrices):
+    size       = matrices.shape[-1]
+    rows, cols = np.triu_indices(size)
+    flat       = tf.reshape(matrices, [-1, size * size])
+    return tf.gather(flat, rows * size + cols, axis = 1)
+
+def triangle_weights(size):
+    # Each off-diagonal entry of a triangle stands for two of the matrix
+    rows, cols = np.triu_indices(size)
+    return np.where(rows == cols, 1.0, 2.0).astype(np.float32)
+
+def gram_distance(targets, grams):
+    # Per image, the mean squared difference between the full Gram matrices,
+    #  computed from the targets' triangles
+    size    = grams.shape[-1]
+    weights = tf.constant(triangle_weights(size))
+    return tf.reduce_sum(weights * tf.square(targets - upper_triangle(grams)), axis = -1) / size**2
+
 # Source layers (with no/fake inputs)
 class Source(Layer):
 
@@ -37,11 +89,39 @@ class Source(Layer):
         base_config = super(Source, self).get_config()
         return {**base_config, 'output_dim' : self.output_dim}
 
+# Normalises each image's channels over its own pixels (no batch statistics),
+#  as used in feed-forward style transfer networks
+class InstanceNormalization(Layer):
+
+    def __init__(self, epsilon = 1e-3, **kwargs):
+        self.epsilon = epsilon
+        super().__init__(**kwargs)
+
+    def build(self, input_shapes):
+        channels    = input_shapes[-1]
+        self.scale  = self.add_weight(name='scale', shape=(channels,), initializer='ones')
+        self.offset = self.add_weight(name='offset', shape=(channels,), initializer='zeros')
+        super().build(input_shapes)
+
+    def call(self, inputs):
+        mean, variance = tf.nn.moments(inputs, axes = [1, 2], keepdims = True)
+        normalized     = (inputs - mean) * tf.math.rsqrt(variance + self.epsilon)
+        return normalized * self.scale + self.offset
+
+    def get_config(self):
+        base_config = super().get_config()
+        return {**base_config, 'epsilon' : self.epsilon}
+
 def precomputed_loss(dummy, loss):
     return loss
 
-def get_image_from_model(model, layer_name = 'image', format_ = 'vgg19'):
+def get_image_from_model(model, layer_name = 'image', format_ = 'vgg19', index = 0):
+    # index picks one image out of a batched image layer
     out_img = model.get_layer(layer_name).get_weights()[0]
+    return deprocess_dream(out_img[index:index + 1], format_)
+
+# A (batch of one) pre-processed image as a displayable uint8 image
+def deprocess_dream(out_img, format_ = 'vgg19'):
     if format_ == 'vgg19':
         out_img = vgg19_deprocess_image(out_img, clip_and_cast = False)
         out_img = out_img - tf.reduce_min(out_img)
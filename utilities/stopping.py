@@ -0,0 +1,54 @@
+from datetime import datetime
+
+class StopCriterion:
+    '''
+        When to stop a dream early: a wall-clock budget and/or a loss plateau
+
+        budget is in seconds. The run stops before a check that would be
+        expected to overrun it (based on the time between checks so far).
+        patience is the number of checks without an improvement of at least
+        min_delta before the loss counts as plateaued. mode says which way
+        is better: 'min' for the Keras models, 'max' for gradient ascent.
+        After a run, best_step and reason say what happened.
+    '''
+    def __init__(self, budget = None, patience = None, min_delta = 0.0, mode = 'min'):
+        assert mode in ['min', 'max']
+        self.budget    = budget
+        self.patience  = patience
+        self.min_delta = min_delta
+        self.mode      = mode
+
+    def start(self):
+        self.start_time = datetime.now()
+        self.last_check = self.start_time
+        self.check_time = 0.0
+        self.best_loss  = None
+        self.best_step  = None
+        self.stale      = 0
+        self.reason     = None
+
+    def elapsed(self):
+        return (datetime.now() - self.start_time).total_seconds()
+
+    def update(self, loss, step):
+        # Record the loss after `step` steps; True if it is the best so far
+        now = datetime.now()
+        self.check_time = max(self.check_time, (now - self.last_check).total_seconds())
+        self.last_check = now
+
+        sign = 1 if self.mode == 'min' else -1
+        if self.best_loss is None or sign * (self.best_loss - loss) > self.min_delta:
+            self.best_loss = loss
+            self.best_step = step
+            self.stale     = 0
+            return True
+
+        self.stale += 1
+        return False
+
+    def should_stop(self):
+        if self.budget is not None and self.elapsed() + self.check_time > self.budget:
+            self.reason = 'budget'
+        elif self.patience is not None and self.stale >= self.patience:
+            self.reason = 'plateau'
+        return self.reason is not None
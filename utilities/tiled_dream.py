@@ -0,0 +1,104 @@
+import tensorflow as tf
+from progress_bar import ProgressBar
+
+# Memory ceiling: the largest tile (in pixels) sent through the network at once.
+#  Activations (and their gradients) scale with the tile, not the image, so a
+#  12MP photo can be dreamt at native resolution on a CPU box
+MAX_TILE_PIXELS = 512 * 512
+
+OCTAVE_SCALE = 1.30
+
+def calc_loss(img, model):
+    # Pass forward the image through the model to retrieve the activations.
+    activations = model(tf.expand_dims(img, axis = 0))
+    return tf.reduce_sum(tf.math.square(activations))
+
+def random_roll(img, maxroll):
+    # Randomly shift the image to avoid tiled boundaries.
+    shift = tf.random.uniform(shape=[2], minval=-maxroll, maxval=maxroll, dtype=tf.int32)
+    shift_down, shift_right = shift[0],shift[1]
+    img_rolled = tf.roll(tf.roll(img, shift_right, axis=1), shift_down, axis=0)
+    return shift_down, shift_right, img_rolled
+
+def tile_edges(length, tile_size):
+    # Split [0, length) into the fewest near-equal tiles of at most tile_size
+    #  (avoids a sliver of a tile at the edge)
+    num_tiles = max(1, -(-length // tile_size))
+    edges     = [(i * length) // num_tiles for i in range(num_tiles + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+class TiledGradients(tf.Module):
+    def __init__(self, model, max_tile_pixels = MAX_TILE_PIXELS):
+        self.model     = model
+        self.tile_size = int(max_tile_pixels ** 0.5)
+
+    @tf.function(
+        input_signature=(
+          tf.TensorSpec(shape=[None,None,3], dtype=tf.float32),)
+    )
+    def tile_gradients(self, tile):
+        # Gradients are taken with respect to the tile alone so nothing at
+        #  the resolution of the full image is ever built inside the graph
+        with tf.GradientTape() as tape:
+            tape.watch(tile)
+            loss = calc_loss(tile, self.model)
+        return tape.gradient(loss, tile)
+
+    def __call__(self, img):
+        shift_down, shift_right, img_rolled = random_roll(img, self.tile_size)
+        height, width = img_rolled.shape[:2]
+
+        # Calculate the gradients tile by tile and stitch them back together
+        rows = []
+        for top, bottom in tile_edges(height, self.tile_size):
+            row = [self.tile_gradients(img_rolled[top:bottom, left:right])
+                   for left, right in tile_edges(width, self.tile_size)]
+            rows.append(tf.concat(row, axis = 1))
+        gradients = tf.concat(rows, axis = 0)
+
+        # Undo the random shift applied to the image and its gradients.
+        gradients = tf.roll(tf.roll(gradients, -shift_right, axis=1), -shift_down, axis=0)
+
+        # Normalize the gradients.
+        gradients /= tf.math.reduce_std(gradients) + 1e-8
+
+        return gradients
+
+
+def run_deep_dream_with_octaves(img,
+                                get_tiled_gradients,
+                                steps_per_octave = 100,
+                                step_size = 1.0,
+                                octaves = range(-3, 1),
+                                octave_scale = OCTAVE_SCALE):
+    '''
+        Dream on a (pre-processed) image of any size
+
+        The image is dreamt over a pyramid of octaves, from coarse up to
+        octave 0 (the native resolution), with tiled gradients at each scale.
+        Returns the dream at the size of the input image.
+    '''
+    batched    = len(img.shape) == 4
+    img        = tf.reshape(img, tf.shape(img)[-3:])
+    base_shape = tf.cast(tf.shape(img)[:-1], tf.float32)
+
+    progress_bar = ProgressBar(steps_per_octave * len(octaves))
+    progress_bar.start()
+    steps_done   = 0
+
+    for octave in octaves:
+        # Scale the image based on the octave
+        new_shape = tf.cast(base_shape * (octave_scale ** octave), tf.int32)
+        img       = tf.image.resize(img, new_shape)
+
+        for step in range(steps_per_octave):
+            gradients = get_tiled_gradients(img)
+            img       = img + gradients * step_size
+
+            steps_done += 1
+            progress_bar.update(steps_done)
+
+    img = tf.image.resize(img, tf.cast(base_shape, tf.int32))
+    if batched:
+        img = tf.expand_dims(img, axis = 0)
+    return img
@@ -0,0 +1,32 @@
+from math import log
+
+# Long sides to serve (and warm) at; each also gets a landscape and portrait
+#  variant per aspect ratio. All sides are multiples of 32
+RESOLUTIONS   = (512, 768, 896)
+ASPECT_RATIOS = (4 / 3, 16 / 9)
+# Buckets this much further (in log aspect ratio) from a photo's aspect
+#  ratio than the closest still count as its aspect ratio (sides rounded to
+#  multiples of 32 move a bucket's a little)
+ASPECT_TOLERANCE = 0.1
+
+def resolution_buckets(resolutions = RESOLUTIONS, aspect_ratios = ASPECT_RATIOS, multiple = 32):
+    buckets = []
+    for size in resolutions:
+        buckets.append((size, size))
+        for aspect_ratio in aspect_ratios:
+            short = max(multiple, int(round(size / aspect_ratio / multiple)) * multiple)
+            buckets += [(short, size), (size, short)]
+    return buckets
+
+def nearest_bucket(shape, buckets = None):
+    # The closest aspect ratio, at the largest size that does not enlarge
+    #  the photo (or the smallest, if every bucket would)
+    buckets = buckets if buckets is not None else resolution_buckets()
+    height, width = shape
+    def aspect_distance(bucket):
+        return abs(log((bucket[0] / bucket[1]) / (height / width)))
+    closest = min(map(aspect_distance, buckets))
+    matches = sorted([bucket for bucket in buckets if aspect_distance(bucket) <= closest + ASPECT_TOLERANCE],
+                     key = lambda bucket : bucket[0] * bucket[1])
+    fitting = [bucket for bucket in matches if bucket[0] <= height and bucket[1] <= width]
+    return fitting[-1] if fitting else matches[0]
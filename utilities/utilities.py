@@ -14,6 +14,8 @@ from sklearn.metrics import (
 
 from dream_image    import DreamImage
 from deep_dream     import DeepDream
+from tiled_dream    import TiledGradients, run_deep_dream_with_octaves
+from traced_dreams  import resolution_buckets, nearest_bucket
 from images         import (
     show_image,
     load_image,
@@ -23,11 +25,19 @@ from images         import (
     inceptionV3_deprocess_image,
 )
 from progress_bar import ProgressBar
+from compiled_step import CompiledStep, LbfgsStep, optimizers, get_compiled_step, release_compiled_steps
+from stopping     import StopCriterion
 from keras_layers import (
     gram_matrix,
+    sampled_gram_matrix,
+    upper_triangle,
+    triangle_weights,
+    gram_distance,
     Source,
     precomputed_loss,
     get_image_from_model,
+    deprocess_dream,
+    InstanceNormalization,
     dummy, dummy_input
 )
 
@@ -294,3 +304,8 @@ def _get_class_names():
     return class_names
 
 class_names = _get_class_names()
+
+def get_artist_indices(artists):
+    # Positions in class_names (as used by the classifier's output layer)
+    names = [name.strip() for name in class_names]
+    return [names.index(artist.strip()) for artist in artists]
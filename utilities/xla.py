@@ -0,0 +1,77 @@
+import tensorflow as tf
+from datetime import datetime
+
+def shape_key(args):
+    return tuple(tuple(tensor.shape) for tensor in tf.nest.flatten(args)
+                 if isinstance(tensor, (tf.Tensor, tf.Variable)))
+
+def seconds(function, args):
+    start = datetime.now()
+    function(*args)
+    return (datetime.now() - start).total_seconds()
+
+class XlaSwitch:
+    '''
+        Opt-in XLA (jit_compile) for a dream or optimisation step, with a
+        measured fallback
+
+        Wraps python_function as both a default and an XLA tf.function.
+        calibrate() runs both on real arguments and keeps XLA for that input
+        shape only if it compiles and is faster; otherwise (or until
+        calibrated, or when disabled) calls go to the default executor.
+        calibrate() actually runs the function, so callers with state must
+        reset it afterwards.
+    '''
+    def __init__(self, python_function, input_signature = None, enabled = True):
+        self.name    = python_function.__name__
+        self.enabled = enabled
+        self.default = tf.function(python_function, input_signature = input_signature)
+        self.xla     = tf.function(python_function, input_signature = input_signature,
+                                   jit_compile = True)
+        self.use_xla = {}
+        self.timings = {}
+
+    def is_calibrated(self, *args):
+        return not self.enabled or shape_key(args) in self.use_xla
+
+    def calibrate(self, *args):
+        key = shape_key(args)
+
+        # First calls trace (and compile); time the second
+        self.default(*args)
+        timing = {'default' : seconds(self.default, args)}
+        try:
+            self.xla(*args)
+            timing['xla'] = seconds(self.xla, args)
+        except Exception as e:
+            print(f'{self.name} -- XLA compilation failed, using the default executor ({e})')
+            timing['xla'] = None
+
+        self.timings[key] = timing
+        self.use_xla[key] = timing['xla'] is not None and timing['xla'] < timing['default']
+        return self.use_xla[key]
+
+    def __call__(self, *args):
+        if self.enabled and self.use_xla.get(shape_key(args), False):
+            return self.xla(*args)
+        return self.default(*args)
+
+def benchmark(python_function, args_by_resolution, steps):
+    '''
+        Print steps/sec with and without XLA for each resolution
+
+        args_by_resolution maps a resolution label to the arguments of one
+        call of python_function, which must run `steps` steps
+    '''
+    results = {}
+    for resolution, args in args_by_resolution.items():
+        switch = XlaSwitch(python_function)
+        switch.calibrate(*args)
+        timing = switch.timings[shape_key(args)]
+        default_rate = steps / timing['default']
+        xla_rate     = steps / timing['xla'] if timing['xla'] else None
+        results[resolution] = (default_rate, xla_rate)
+
+        xla_str = f'{xla_rate:.2f}' if xla_rate else 'failed'
+        print(f'{resolution}: default {default_rate:.2f} steps/s, XLA {xla_str} steps/s')
+    return results